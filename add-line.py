@@ -6,13 +6,14 @@ import json
 import string
 import os.path
 import argparse
+import difflib
 import datetime
 from pprint import pprint
 from collections import namedtuple,defaultdict
 
 import gtfs_to_osm
 
-from osm import OsmParser,OsmWriter,Node,Relation,Way
+from osm import OsmParser,OsmWriter,Node,Relation,Way,distances
 
 
 
@@ -25,7 +26,16 @@ CHANGE_NAME = [
     ("-Du-", "-du-"),
 ]
 
+_formatted_stop_names = {}
+
 def format_stop_name(name, route_type, agency):
+    key = (name, route_type, agency)
+    formatted = _formatted_stop_names.get(key)
+    if formatted is None:
+        formatted = _formatted_stop_names[key] = _format_stop_name(name, route_type, agency)
+    return formatted
+
+def _format_stop_name(name, route_type, agency):
     if agency == "HAUTE-GARONNE":
         if name.find(" - ") >=  0:
             city_name, stop_name = name.split(" - ", 1)
@@ -56,44 +66,106 @@ def add_todo_fixme(item, text):
     if text not in item.tags.get("fixme","").split(";"):
         item.attrs["action"] = "modify"
         if item.tags.get("fixme"):
-            item.tags["fixme"] = text + ";" + item.tags["fixme"]
+            item.own_tags()["fixme"] = text + ";" + item.tags["fixme"]
         else:
-            item.tags["fixme"] = text
+            item.own_tags()["fixme"] = text
 
 
 NORMALIZE_NAME = [
     (" - ", "-"),
 ]
 
+_normalized_names = {}
+
 def normalize_name(name):
     if name:
-        for v1,v2 in NORMALIZE_NAME:
-            name = name.replace(v1,v2)
-        name = name.lower()
+        normalized = _normalized_names.get(name)
+        if normalized is None:
+            normalized = name
+            for v1,v2 in NORMALIZE_NAME:
+                normalized = normalized.replace(v1,v2)
+            normalized = _normalized_names[name] = normalized.lower()
+        return normalized
     return name
 
+def find_all(s, sub):
+    """Yield the indexes of all the (possibly overlapping) occurrences of sub in s."""
+    i = s.find(sub)
+    while i >= 0:
+        yield i
+        i = s.find(sub, i + 1)
+
+class NameIndex(object):
+    """
+    Normalized forms of the names wanted for a stop, so that the names of
+    the OSM nodes are checked with set lookups instead of string predicates.
+
+    A normalized name matches a wanted one if it is equal to it, if it is
+    its part before or after a " - ", or if it is "wanted (...)" or
+    "... (wanted)". The "-TAD" suffix of name_ok never matches a lowercase
+    normalized name, so it has no entry here.
+    """
+    def __init__(self, wanted_names):
+        self.exact = set()
+        self.parts = set()
+        for wanted_name in map(normalize_name, wanted_names):
+            self.exact.add(wanted_name)
+            for i in find_all(wanted_name, " - "):
+                self.parts.add(wanted_name[:i])
+                self.parts.add(wanted_name[i+3:])
+
+    def match(self, name):
+        name = normalize_name(name)
+        if not name:
+            return False
+        if (name in self.exact) or (name in self.parts):
+            return True
+        parenthesis = name.endswith(")")
+        for i in find_all(name, " ("):
+            if name[:i] in self.exact:
+                return True
+            if parenthesis and (i + 2 < len(name)) and (name[i+2:-1] in self.exact):
+                return True
+        return False
+
+    def ok(self, names):
+        for name in names:
+            if self.match(name):
+                return True
+        return False
+
+    def similarity(self, names):
+        """Return the best difflib ratio, between 0 and 1, of the normalized
+           names with the wanted names (1 if ok(names)), or None if all the
+           names are empty."""
+        names = [name for name in names if name]
+        if not names:
+            return None
+        if self.ok(names):
+            return 1.0
+        names = list(map(normalize_name, names))
+        best = 0.0
+        matcher = difflib.SequenceMatcher()
+        for wanted_name in self.exact:
+            matcher.set_seq2(wanted_name)
+            for name in names:
+                matcher.set_seq1(name)
+                if matcher.real_quick_ratio() > best and matcher.quick_ratio() > best:
+                    best = max(best, matcher.ratio())
+        return best
+
 def name_ok(names, wanted_names):
     if type(names) not in (tuple, list):
         names = [names]
     if type(wanted_names) not in (tuple, list):
         wanted_names = [wanted_names]
-    for name in map(normalize_name, names):
-        if name:
-            for wanted_name in map(normalize_name, wanted_names):
-                if name == wanted_name \
-                        or name == wanted_name + "-TAD" \
-                        or wanted_name.startswith(name + " - ") \
-                        or wanted_name.endswith(" - " + name) \
-                        or name.startswith(wanted_name + " (") \
-                        or name.endswith(" (" + wanted_name + ")"):
-                    return True
-    return False
+    return NameIndex(wanted_names).ok(names)
 
 
 def test_and_set(item, tag_name, tag_value):
     if item.tags.get(tag_name) != tag_value:
         item.attrs["action"] = "modify"
-        item.tags[tag_name] = tag_value
+        item.own_tags()[tag_name] = tag_value
 
 def trip_comparison_key(list_of_stops):
     return (
@@ -113,36 +185,215 @@ def remove_following_duplicate(from_list, key=lambda v:v):
             previous = key(from_list[i])
             i = i + 1
 
-def get_or_add_stops_by_ref(osm_data, stop_list, all_stops, ref_attribute, route_type, agency):
-    route_tag = gtfs_to_osm.route_type_route_tag[route_type]
-    stops_by_ref = {}
-    osm_node_by_ref = defaultdict(list)
-    all_stop_refs = set([stop.stop_code for stop in all_stops])
-    for stop in stop_list:
-        stops_by_ref[stop.stop_code] = stop
-    for node in osm_data.nodes.values():
-        if ((node.tags.get("public_transport") == "stop_position")
-                and (node.tags.get("highway") == "bus_stop")):
-            node.attrs["action"] = "modify"
-            del(node.tags["highway"])
-        elif ((node.tags.get("highway") == "bus_stop")
-                or (node.tags.get("public_transport") == "platform")):
-            test_and_set(node, "public_transport", "platform")
-            test_and_set(node, "highway", "bus_stop")
-            ref = node.tags.get(ref_attribute)
-            if ref:
-                if ref in stops_by_ref:
-                    osm_node_by_ref[ref].append(node)
-                else:
-                    if (ref_attribute != "ref") and (ref not in all_stop_refs):
-                        add_todo_fixme(node, ref_attribute + " non trouvé dans les données de référence " + agency)
-    for ref, node_list in list(osm_node_by_ref.items()):
-        stop = stops_by_ref[ref]
+# Distance max (en m) pour signaler un arrêt OSM existant sans ref
+# à côté d'un arrêt importé.
+NEARBY_STOP_DISTANCE = 50
+
+# Rapprochement approché des arrêts sans ref_attribute: distance max (en m),
+# similarité de nom min (pour les arrêts nommés) et score min.
+FUZZY_MATCH_DISTANCE = 50
+FUZZY_MATCH_MIN_NAME_SIMILARITY = 0.5
+FUZZY_MATCH_MIN_SCORE = 0.6
+
+def fuzzy_match_score(distance, name_similarity, route_tags, node):
+    """Score between 0 and 1 of the match of an OSM platform without ref
+       with a GTFS stop served by route_tags (bus, tram...), or None if they
+       can not be the same stop. name_similarity is None if the node has
+       no name."""
+    if name_similarity is None:
+        name_similarity = 0.5
+    elif name_similarity < FUZZY_MATCH_MIN_NAME_SIMILARITY:
+        return None
+    modes = [node.tags.get(route_tag) for route_tag in route_tags]
+    if "yes" in modes:
+        mode_score = 1.0
+    elif all(mode == "no" for mode in modes):
+        return None
+    elif any(node.tags.get(tag) == "yes" for tag in set(gtfs_to_osm.route_type_route_tag.values())):
+        mode_score = 0.0
+    else:
+        mode_score = 0.5
+    score = (0.4 * (1 - distance / FUZZY_MATCH_DISTANCE)
+             + 0.4 * name_similarity
+             + 0.2 * mode_score)
+    if score < FUZZY_MATCH_MIN_SCORE:
+        return None
+    return score
+
+def is_platform(node):
+    return ((node.tags.get("highway") == "bus_stop")
+            or (node.tags.get("public_transport") == "platform"))
+
+def is_stop(item):
+    return (item.type() == "node") and (is_platform(item)
+            or (item.tags.get("public_transport") == "stop_position"))
+
+class StopMatcher(object):
+    """
+    Match the GTFS stops of an agency with the OSM platforms, for a whole run.
+
+    The OSM nodes are classified, and the platforms indexed by ref_attribute,
+    only once; the stops of each trip are then looked up in this index and
+    the OSM nodes created for missing stops are added to it.
+
+    If fuzzy_match is true, the stops of the agency missing in the index are
+    matched once with the nearby OSM platforms without ref, scored on
+    distance, name and route type, over all the candidate pairs (see
+    match_nodes). The match of a stop is applied when a trip first uses it,
+    before creating the nodes of the stops left.
+    """
+    def __init__(self, osm_data, gtfs, agency, fuzzy_match=True):
+        self.osm_data = osm_data
+        self.agency = agency
+        self.ref_attribute = gtfs_to_osm.REF_ATTRIBUTE_OF_AGENCY.get(agency, "ref")
+        self.all_stop_refs = set([stop.stop_code for stop in gtfs.stops.values()])
+        self.nodes_by_ref = defaultdict(list)
+        self.node_by_stop = {}
+        self.name_indexes = {}
+        for node in list(osm_data.nodes.values()):
+            if ((node.tags.get("public_transport") == "stop_position")
+                    and (node.tags.get("highway") == "bus_stop")):
+                node.attrs["action"] = "modify"
+                del(node.own_tags()["highway"])
+            elif is_platform(node):
+                test_and_set(node, "public_transport", "platform")
+                test_and_set(node, "highway", "bus_stop")
+                ref = node.tags.get(self.ref_attribute)
+                if ref:
+                    self.nodes_by_ref[ref].append(node)
+                    if (self.ref_attribute != "ref") and (ref not in self.all_stop_refs):
+                        add_todo_fixme(node, self.ref_attribute + " non trouvé dans les données de référence " + agency)
+        self.matches_by_ref = self.match_nodes(gtfs) if fuzzy_match else {}
+
+    def get_or_add_stops_by_ref(self, stop_list, route_type):
+        """Return a dict stop_code -> OSM node for the stops of stop_list,
+           creating the nodes not found in OSM.
+        """
+        stops_by_ref = {}
+        for stop in stop_list:
+            stops_by_ref[stop.stop_code] = stop
+        osm_node_by_ref = {}
+        for ref, stop in stops_by_ref.items():
+            key = (ref, stop.stop_id)
+            if key not in self.node_by_stop and self.nodes_by_ref.get(ref):
+                self.node_by_stop[key] = self.check_nodes(stop, self.nodes_by_ref[ref], route_type)
+            if key in self.node_by_stop:
+                osm_node_by_ref[ref] = self.node_by_stop[key]
+
+        missing_stops = []
+        missing_refs = set()
+        for stop in stop_list:
+            if stop.stop_code not in osm_node_by_ref and stop.stop_code not in missing_refs:
+                missing_stops.append(stop)
+                missing_refs.add(stop.stop_code)
+        for stop in missing_stops:
+            match = self.matches_by_ref.pop(stop.stop_code, None)
+            if match:
+                ref = stop.stop_code
+                node = self.apply_match(stop, route_type, *match)
+                self.nodes_by_ref[ref].append(node)
+                self.node_by_stop[(ref, stop.stop_id)] = node
+                osm_node_by_ref[ref] = node
+        missing_stops = [stop for stop in missing_stops if stop.stop_code not in osm_node_by_ref]
+        # plateformes sans ref proches des arrêts à créer, en un seul appel
+        nearby_list = self.osm_data.node_index(is_platform).nearest_many(
+            [(float(stop.stop_lon), float(stop.stop_lat)) for stop in missing_stops],
+            NEARBY_STOP_DISTANCE,
+            predicate=lambda node: not node.tags.get(self.ref_attribute))
+        for stop, nearby in zip(missing_stops, nearby_list):
+            ref = stop.stop_code
+            node = self.create_node(stop, route_type, nearby)
+            self.nodes_by_ref[ref].append(node)
+            self.node_by_stop[(ref, stop.stop_id)] = node
+            osm_node_by_ref[ref] = node
+        return osm_node_by_ref
+
+    def name_index(self, *wanted_names):
+        """Return the NameIndex of wanted_names, built once per run."""
+        name_index = self.name_indexes.get(wanted_names)
+        if name_index is None:
+            name_index = self.name_indexes[wanted_names] = NameIndex(wanted_names)
+        return name_index
+
+    def match_nodes(self, gtfs):
+        """Match the stops of the agency whose ref is not in OSM with the OSM
+           platforms without ref_attribute, and return a dict
+           ref -> (node, score, distance). All the candidate pairs are taken
+           greedily by decreasing score, each stop and node being used only
+           once, so that the result does not depend on the order of the lines."""
+        ref_attribute = self.ref_attribute
+        agencies_ids = set([
+            agency_id for agency_id, agency in gtfs.agency.items() if agency.agency_name == self.agency])
+        stop_by_ref = {}
+        route_types_by_ref = defaultdict(set)
+        for list_of_stops in gtfs.all_lists_of_stops:
+            if not (gtfs.agencies_ids_by_list_of_stops[list_of_stops] & agencies_ids):
+                continue
+            route_types = set([
+                gtfs.routes[route_id].route_type for route_id in gtfs.routes_ids_by_list_of_stops[list_of_stops]])
+            for stop_id in list_of_stops:
+                stop = gtfs.stops[stop_id]
+                if stop.stop_code not in self.nodes_by_ref:
+                    stop_by_ref.setdefault(stop.stop_code, stop)
+                    route_types_by_ref[stop.stop_code] |= route_types
+        refs = sorted(stop_by_ref)
+        candidates_list = self.osm_data.node_index(is_platform).within_many(
+            [(float(stop_by_ref[ref].stop_lon), float(stop_by_ref[ref].stop_lat)) for ref in refs],
+            FUZZY_MATCH_DISTANCE,
+            predicate=lambda node: not node.tags.get(ref_attribute))
+        pairs = []
+        for ref, candidates in zip(refs, candidates_list):
+            stop = stop_by_ref[ref]
+            route_types = sorted(route_types_by_ref[ref])
+            route_tags = set([gtfs_to_osm.route_type_route_tag[route_type] for route_type in route_types])
+            name_index = self.name_index(
+                format_stop_name(stop.stop_name, route_types[0], self.agency), stop.stop_name)
+            for distance, node in candidates:
+                score = fuzzy_match_score(
+                    distance,
+                    name_index.similarity([node.tags.get("name"),
+                                           node.tags.get("alt_name"),
+                                           node.tags.get("short_name"),
+                                           node.tags.get("official_name")]),
+                    route_tags, node)
+                if score is not None:
+                    pairs.append((-score, distance, ref, node.id(), node))
+        pairs.sort(key=lambda pair: pair[:4])
+        matches_by_ref = {}
+        matched_nodes = set()
+        for score, distance, ref, node_id, node in pairs:
+            if (ref in matches_by_ref) or (node_id in matched_nodes):
+                continue
+            matched_nodes.add(node_id)
+            matches_by_ref[ref] = (node, -score, distance)
+        return matches_by_ref
+
+    def apply_match(self, stop, route_type, node, score, distance):
+        """Give to the node matched with stop by match_nodes the ref of stop.
+           The node is checked as by check_nodes and gets a fixme asking to
+           verify the match. Return the node."""
+        route_tag = gtfs_to_osm.route_type_route_tag[route_type]
+        print("match stop", stop.stop_code, stop.stop_name, "with", node.textid(),
+              "(score %.2f, %d m)" % (score, round(distance)))
+        self.check_nodes(stop, [node], route_type)
+        if not node.tags.get(route_tag):
+            test_and_set(node, route_tag, "yes")
+        add_todo_fixme(node, self.ref_attribute + " ajouté par rapprochement avec l'arrêt "
+            + stop.stop_name + " des données de référence " + self.agency + ", à vérifier")
+        return node
+
+    def check_nodes(self, stop, node_list, route_type):
+        """Check the OSM nodes having the ref of stop, and return the best one."""
+        ref_attribute = self.ref_attribute
+        agency = self.agency
+        ref = stop.stop_code
         stop_name = format_stop_name(stop.stop_name, route_type, agency)
+        name_index = self.name_index(stop_name, stop.stop_name)
         best_distance = None
         best_node = None
-        for node in node_list:
-            distance = node.distance(Node(attrs={"lon": stop.stop_lon, "lat": stop.stop_lat}))
+        node_distances = distances(float(stop.stop_lon), float(stop.stop_lat),
+                                   [(node.lon(), node.lat()) for node in node_list])
+        for node, distance in zip(node_list, node_distances):
             if (best_distance is None) or (distance < best_distance):
                 best_node = node
                 best_distance = distance
@@ -161,43 +412,49 @@ def get_or_add_stops_by_ref(osm_data, stop_list, all_stops, ref_attribute, route
                     test_and_set(node, "wheelchair", "no")
                 elif node.tags.get("wheelchair") != "no":
                     add_todo_fixme(node, "wheelchair != no contrairement aux données de référence " + agency)
-            if not name_ok([node.tags.get("name"),
-                            node.tags.get("alt_name"),
-                            node.tags.get("short_name"),
-                            node.tags.get("official_name"),
-                            node.tags.get("name:" + ref_attribute),
-                           ],
-                           [stop_name, stop.stop_name]):
+            if not name_index.ok([node.tags.get("name"),
+                                  node.tags.get("alt_name"),
+                                  node.tags.get("short_name"),
+                                  node.tags.get("official_name"),
+                                  node.tags.get("name:" + ref_attribute),
+                                 ]):
                 add_todo_fixme(node, "name != " + stop_name)
-        osm_node_by_ref[ref] = best_node
+        return best_node
 
-    for stop in stop_list:
+    def create_node(self, stop, route_type, nearby):
+        """Create the OSM node of stop. nearby is the (distance, node) of the
+           nearest platform without ref_attribute, or (None, None)."""
+        ref_attribute = self.ref_attribute
+        agency = self.agency
         ref = stop.stop_code
         stop_name = format_stop_name(stop.stop_name, route_type, agency)
-        if ref not in osm_node_by_ref:
-            node = osm_data.create_node(
-                attrs={
-                    "lon": stop.stop_lon,
-                    "lat": stop.stop_lat,
-                    "action": "modify",
-                },
-                tags={
-                    "name": stop_name,
-                    "highway" : "bus_stop",
-                    "public_transport": "platform",
-                    route_tag: "yes",
-                    ref_attribute: ref,
-                    "source:" + ref_attribute: gtfs_to_osm.SOURCE_ATTRIBUTE_OF_AGENCY.get(agency,""),
-                    "fixme": "TODO: arrêt importé à fusionner si déjà existante et/ou à vérifier",
-                })
-            if stop.wheelchair_boarding == "1":
-                test_and_set(node, "wheelchair", "yes")
-            elif stop.wheelchair_boarding == "2":
-                test_and_set(node, "wheelchair", "no")
-            osm_node_by_ref[ref] = node
-    return osm_node_by_ref
-
-def add_trip(gtfs, trip, route, list_of_stops_id, osm_data, start_date, end_date):
+        nearby_distance, nearby_node = nearby
+        node = self.osm_data.create_node(
+            attrs={
+                "lon": stop.stop_lon,
+                "lat": stop.stop_lat,
+                "action": "modify",
+            },
+            tags={
+                "name": stop_name,
+                "highway" : "bus_stop",
+                "public_transport": "platform",
+                gtfs_to_osm.route_type_route_tag[route_type]: "yes",
+                ref_attribute: ref,
+                "source:" + ref_attribute: gtfs_to_osm.SOURCE_ATTRIBUTE_OF_AGENCY.get(agency,""),
+                "fixme": "TODO: arrêt importé à fusionner si déjà existante et/ou à vérifier",
+            })
+        if stop.wheelchair_boarding == "1":
+            test_and_set(node, "wheelchair", "yes")
+        elif stop.wheelchair_boarding == "2":
+            test_and_set(node, "wheelchair", "no")
+        if nearby_node is not None:
+            add_todo_fixme(node, "arrêt existant sans " + ref_attribute + " à "
+                + str(int(round(nearby_distance))) + " m: " + nearby_node.textid())
+        return node
+
+def add_trip(gtfs, trip, route, list_of_stops_id, osm_data, start_date, end_date, stop_matchers,
+             fuzzy_match=True):
     osm_stop_by_ref = {}
     stop_list = [gtfs.stops[stop_id] for stop_id in list_of_stops_id]
     remove_following_duplicate(stop_list, key=lambda stop:stop.stop_code)
@@ -205,14 +462,17 @@ def add_trip(gtfs, trip, route, list_of_stops_id, osm_data, start_date, end_date
     name = format_relation_name(route, stop_list, agency)
     print("add trip", name)
     ref_attribute = gtfs_to_osm.REF_ATTRIBUTE_OF_AGENCY.get(agency, "ref")
-    duration = gtfs.get_duration_from_list_of_stops(list_of_stops_id)
-    interval = gtfs.get_interval_from_list_of_stops(list_of_stops_id, start_date=start_date, end_date=end_date)
-    opening_hours = gtfs.get_opening_hours_from_list_of_stops(list_of_stops_id, start_date=start_date, end_date=end_date)
+    schedule = gtfs.get_schedule_table(start_date, end_date)[list_of_stops_id]
+    duration = schedule.duration
+    interval = schedule.interval
+    opening_hours = schedule.opening_hours
     route_tag = gtfs_to_osm.route_type_route_tag[route.route_type]
     colour_tag = "#" + route.route_color.upper()
     route_ref = gtfs.get_ref_from_list_of_stops(list_of_stops_id)
 
-    osm_stop_by_ref = get_or_add_stops_by_ref(osm_data, stop_list, gtfs.stops.values(), ref_attribute, route.route_type, agency)
+    if agency not in stop_matchers:
+        stop_matchers[agency] = StopMatcher(osm_data, gtfs, agency, fuzzy_match)
+    osm_stop_by_ref = stop_matchers[agency].get_or_add_stops_by_ref(stop_list, route.route_type)
 
     rel = osm_data.create_relation(
         attrs={ "action":"modify"},
@@ -240,13 +500,20 @@ def trip_comparison_key(gtfs, list_of_stops):
         len(list_of_stops),
         len(gtfs.trips_by_list_of_stops[list_of_stops]))
 
-def add_line(gtfs, osm_data, line_ref, date):
+def add_line(gtfs, osm_data, line_ref, date, stop_matchers=None, fuzzy_match=True):
+    """Add the routes and route_master of the line to osm_data.
+       Return False if no trip of the line is found at this date.
+       stop_matchers: StopMatcher by agency, to share between several calls.
+       fuzzy_match: match the stops with OSM platforms without ref (see StopMatcher).
+    """
+    if stop_matchers is None:
+        stop_matchers = {}
     found = False
     start_date = date
     end_date = date + datetime.timedelta(days=7)
     routes_master_members = []
     route_master = None
-    for list_of_stops in sorted(gtfs.all_lists_of_stops, key=lambda s: trip_comparison_key(gtfs,s), reverse=True):
+    for list_of_stops in sorted(gtfs.lists_of_stops_by_ref.get(line_ref, []), key=lambda s: trip_comparison_key(gtfs,s), reverse=True):
         if ((gtfs.get_end_date_from_list_of_stops(list_of_stops) >= start_date)
                 and (gtfs.get_start_date_from_list_of_stops(list_of_stops) <= end_date)):
             trip_id_list = list(gtfs.trips_by_list_of_stops[list_of_stops])
@@ -255,7 +522,8 @@ def add_line(gtfs, osm_data, line_ref, date):
             if route.route_short_name == line_ref:
                 found = True
                 route_master = route
-                rel = add_trip(gtfs, trip, route, list_of_stops, osm_data, start_date, end_date)
+                rel = add_trip(gtfs, trip, route, list_of_stops, osm_data, start_date, end_date,
+                               stop_matchers, fuzzy_match)
                 routes_master_members.append(rel)
     if found:
         rel = osm_data.create_relation(
@@ -271,9 +539,18 @@ def add_line(gtfs, osm_data, line_ref, date):
             })
         for route_rel in routes_master_members:
             rel.add_member(route_rel, "")
-    else:
-        print("ERROR: no trip found with short_name =", line_ref, "at date", str(date))
-        sys.exit(-1)
+    return found
+
+def add_lines(gtfs, osm_data, lines_refs, date, fuzzy_match=True):
+    """Add several lines to osm_data, sharing the GTFS and OSM data between them.
+       Return the list of the lines not found.
+    """
+    not_found = []
+    stop_matchers = {}
+    for line_ref in lines_refs:
+        if not add_line(gtfs, osm_data, line_ref, date, stop_matchers, fuzzy_match):
+            not_found.append(line_ref)
+    return not_found
 
 def parse_date(date_str):
     return datetime.datetime.strptime(date_str, '%Y-%m-%d').date()
@@ -286,14 +563,38 @@ def add_line_main():
     parser.add_argument('-d', "--date", help="date of trip",
                         type=parse_date,
                         default=datetime.date.today())
+    parser.add_argument("--no-cache", help="do not use nor write the GTFS cache",
+                        action="store_true")
+    parser.add_argument("--only-stops", help="only read the stops, and the relations using them,"
+                        " from osm_file (the other items are not written, so --output is required)",
+                        action="store_true")
+    parser.add_argument("-a", "--all", help="add all the lines of the GTFS",
+                        action="store_true")
+    parser.add_argument("--no-fuzzy-match", help="only use the ref of the OSM stops, do not match"
+                        " the stops with nearby OSM platforms without ref",
+                        action="store_true")
     parser.add_argument('osm_file')
-    parser.add_argument('line_ref')
+    parser.add_argument('line_ref', nargs="*")
     args = parser.parse_args()
+    if not (args.line_ref or args.all):
+        parser.error("give at least one line_ref, or --all")
+    if args.only_stops and ((not args.output)
+            or os.path.abspath(args.output) == os.path.abspath(args.osm_file)):
+        # le fichier écrit n'a que les arrêts: ne pas écraser osm_file
+        parser.error("--only-stops needs an --output file other than osm_file")
     print("Read GTFS in " + args.gtfs)
-    gtfs = gtfs_to_osm.MyGTFS(args.gtfs)
+    gtfs = gtfs_to_osm.load_gtfs(args.gtfs, use_cache=not args.no_cache)
     print("parse " + args.osm_file)
-    osm_data = OsmParser().parse(args.osm_file)
-    add_line(gtfs, osm_data, args.line_ref, args.date)
+    osm_data = OsmParser(predicate=is_stop if args.only_stops else None).parse(args.osm_file)
+    if args.all:
+        lines_refs = sorted(gtfs.lists_of_stops_by_ref.keys())
+    else:
+        lines_refs = args.line_ref
+    not_found = add_lines(gtfs, osm_data, lines_refs, args.date, not args.no_fuzzy_match)
+    for line_ref in not_found:
+        print("ERROR: no trip found with short_name =", line_ref, "at date", str(args.date))
+    if not_found and not args.all:
+        sys.exit(-1)
     output_file = args.output or args.osm_file
     print("write " + output_file)
     OsmWriter(osm_data).write_to_file(output_file)
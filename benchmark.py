@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the GTFS loading and OSM export hot paths, on a synthetic
+GTFS feed generated with a fixed seed, so that the results of different
+commits can be compared. The results are written as JSON.
+
+usage:
+
+    ./benchmark.py --routes 300 --trips 60 -o before.json
+"""
+
+import os
+import csv
+import sys
+import json
+import math
+import random
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+import importlib.util
+from timeit import default_timer
+
+import gtfs_to_osm
+from osm import OsmParser, OsmWriter
+from tools import get_git_describe
+
+add_line_module_spec = importlib.util.spec_from_file_location(
+    "add_line", os.path.join(os.path.dirname(os.path.realpath(__file__)), "add-line.py"))
+add_line_module = importlib.util.module_from_spec(add_line_module_spec)
+add_line_module_spec.loader.exec_module(add_line_module)
+
+AGENCY_NAME = "Tisséo"
+CENTER_LON = 1.44
+CENTER_LAT = 43.6
+STOP_SPACING = 300 # meters between two neighbour stops of the grid
+
+# Date fixe des calendriers générés et des calculs d'horaires, pour que
+# les mesures ne dépendent pas du jour où le benchmark est lancé.
+REFERENCE_DATE = datetime.date(2025, 1, 6)
+REFERENCE_END_DATE = REFERENCE_DATE + (gtfs_to_osm.MAX_DATE - gtfs_to_osm.MIN_DATE)
+
+GETTERS = [
+    "get_ref_from_list_of_stops",
+    "get_route_type",
+    "get_agency",
+    "get_name_from_list_of_stops",
+    "get_headsign_from_list_of_stops",
+    "get_services_ids_from_list_of_stops",
+    "get_start_date_from_list_of_stops",
+    "get_end_date_from_list_of_stops",
+    "get_duration_from_list_of_stops",
+    "get_interval_from_list_of_stops",
+    "get_opening_hours_from_list_of_stops",
+    "get_osm_name_from_list_of_stops",
+]
+# getters prenant les dates de début et de fin des horaires
+DATED_GETTERS = (
+    "get_duration_from_list_of_stops",
+    "get_interval_from_list_of_stops",
+    "get_opening_hours_from_list_of_stops",
+)
+
+
+def generate_gtfs(path, stops=2000, routes=100, patterns=2, trips=40, stops_per_pattern=25, shape_step=20, seed=1):
+    """Write a synthetic GTFS feed in the directory path and return the
+       number of rows of each file.
+       The stops are on a grid; each route has patterns lists of stops (a
+       random walk on the grid and its reverse, then variants), each one
+       served by trips trips, and shapes with a point every shape_step meters.
+    """
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    counts = {}
+    def write(filename, header, rows):
+        with open(os.path.join(path, filename), "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            count = 0
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        counts[filename] = count
+
+    width = int(math.ceil(math.sqrt(stops)))
+    lat_step = STOP_SPACING / gtfs_to_osm.METERS_PER_DEGREE
+    lon_step = lat_step / math.cos(CENTER_LAT * math.pi / 180)
+    positions = [
+        (CENTER_LON + (i % width - width / 2) * lon_step + rng.uniform(-0.2, 0.2) * lon_step,
+         CENTER_LAT + (i // width - width / 2) * lat_step + rng.uniform(-0.2, 0.2) * lat_step)
+        for i in range(stops)]
+    write("agency.txt", ["agency_id", "agency_name", "agency_url", "agency_timezone"],
+        [["A1", AGENCY_NAME, "http://example.org", "Europe/Paris"]])
+    write("stops.txt", ["stop_id", "stop_code", "stop_name", "stop_lat", "stop_lon", "wheelchair_boarding"], [
+        ["S%d" % i, "C%d" % i, "Arrêt %d" % i if i % 3 else "Gare - Ville %d" % i, "%.7f" % lat, "%.7f" % lon, i % 3]
+        for i, (lon, lat) in enumerate(positions)])
+    write("routes.txt", ["route_id", "agency_id", "route_short_name", "route_long_name", "route_type", "route_color"], [
+        ["R%d" % r, "A1", str(r + 1), "Ligne %d" % (r + 1), "3" if r % 10 else "0", "%06x" % rng.randrange(1 << 24)]
+        for r in range(routes)])
+    first_date = REFERENCE_DATE - datetime.timedelta(days=30)
+    last_date = first_date + datetime.timedelta(days=365)
+    write("calendar.txt", ["service_id", "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday", "start_date", "end_date"], [
+        ["WK", 1, 1, 1, 1, 1, 0, 0, first_date.strftime("%Y%m%d"), last_date.strftime("%Y%m%d")],
+        ["SA", 0, 0, 0, 0, 0, 1, 0, first_date.strftime("%Y%m%d"), last_date.strftime("%Y%m%d")],
+        ["SU", 0, 0, 0, 0, 0, 0, 1, first_date.strftime("%Y%m%d"), last_date.strftime("%Y%m%d")]])
+    write("calendar_dates.txt", ["service_id", "date", "exception_type"], [
+        ["WK", (first_date + datetime.timedelta(days=d)).strftime("%Y%m%d"), 2] for d in range(0, 365, 45)])
+
+    def random_walk(length):
+        cell = rng.randrange(stops)
+        walk = [cell]
+        while len(walk) < length:
+            neighbours = [
+                c for c in (cell - 1, cell + 1, cell - width, cell + width)
+                if 0 <= c < stops and c not in walk and abs(c % width - cell % width) <= 1]
+            if not neighbours:
+                break
+            cell = rng.choice(neighbours)
+            walk.append(cell)
+        return walk
+
+    lists_of_stops = []
+    for r in range(routes):
+        walk = random_walk(stops_per_pattern)
+        route_patterns = [walk, walk[::-1]]
+        while len(route_patterns) < patterns:
+            # variante: terminus partiel
+            base = route_patterns[len(route_patterns) % 2]
+            route_patterns.append(base[:max(2, len(base) - 1 - rng.randrange(len(base) // 2 + 1))])
+        for p, list_of_stops in enumerate(route_patterns[:patterns]):
+            lists_of_stops.append((r, p, list_of_stops))
+
+    def trips_rows():
+        for r, p, list_of_stops in lists_of_stops:
+            for t in range(trips):
+                service_id = ("WK", "WK", "WK", "SA", "SU")[t % 5]
+                yield ["R%d" % r, service_id, "T%d_%d_%d" % (r, p, t), "Vers Arrêt %d" % list_of_stops[-1], "SH%d_%d" % (r, p)]
+    write("trips.txt", ["route_id", "service_id", "trip_id", "trip_headsign", "shape_id"], trips_rows())
+
+    def stop_times_rows():
+        for r, p, list_of_stops in lists_of_stops:
+            for t in range(trips):
+                time = 5 * 3600 + t * (18 * 3600 // max(trips, 1)) + rng.randrange(60)
+                for sequence, stop in enumerate(list_of_stops):
+                    formatted = gtfs_to_osm.format_seconds(time)
+                    yield ["T%d_%d_%d" % (r, p, t), formatted, formatted, "S%d" % stop, sequence]
+                    time += 60 + rng.randrange(60)
+    write("stop_times.txt", ["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence"], stop_times_rows())
+
+    def shapes_rows():
+        for r, p, list_of_stops in lists_of_stops:
+            sequence = 0
+            distance = 0.0
+            points = [positions[stop] for stop in list_of_stops]
+            for (a_lon, a_lat), (b_lon, b_lat) in zip(points, points[1:]):
+                length = gtfs_to_osm.METERS_PER_DEGREE * math.hypot(
+                    (b_lon - a_lon) * math.cos(CENTER_LAT * math.pi / 180), b_lat - a_lat)
+                steps = max(1, int(length // shape_step))
+                for step in range(steps):
+                    f = step / steps
+                    yield ["SH%d_%d" % (r, p), "%.7f" % (a_lat + f * (b_lat - a_lat)), "%.7f" % (a_lon + f * (b_lon - a_lon)), sequence, "%.1f" % (distance + f * length)]
+                    sequence += 1
+                distance += length
+            yield ["SH%d_%d" % (r, p), "%.7f" % points[-1][1], "%.7f" % points[-1][0], sequence, "%.1f" % distance]
+    write("shapes.txt", ["shape_id", "shape_pt_lat", "shape_pt_lon", "shape_pt_sequence", "shape_dist_traveled"], shapes_rows())
+    return counts
+
+def generate_stops_osm(gtfs, filename, seed=1):
+    """Write an OSM file of existing stops for add_line: most of the GTFS
+       stops, with their ref, some without ref, moved a little."""
+    rng = random.Random(seed)
+    ref_attribute = gtfs_to_osm.REF_ATTRIBUTE_OF_AGENCY.get(AGENCY_NAME, "ref")
+    with gtfs_to_osm.OsmStreamWriter(filename, {"version": "0.6"}) as writer:
+        for i, stop in enumerate(gtfs.stops.values()):
+            kind = rng.random()
+            if kind > 0.9:
+                continue
+            tags = {"highway": "bus_stop", "public_transport": "platform", "name": stop.stop_name}
+            if kind < 0.7:
+                tags[ref_attribute] = stop.stop_code
+            lat = float(stop.stop_lat) + rng.uniform(-1e-4, 1e-4)
+            lon = float(stop.stop_lon) + rng.uniform(-1e-4, 1e-4)
+            writer.node(i + 1, repr(lon), repr(lat), tags, version="1")
+
+
+def traced_peak_mb(function):
+    """Run function() under tracemalloc and return the peak of the memory
+       allocated by the run, in megabytes. Unlike ru_maxrss, which is the
+       maximum of the whole process, it does not include the memory kept
+       by the previous stages."""
+    tracemalloc.start()
+    try:
+        function()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return round(peak / (1024.0 * 1024.0), 3)
+
+class Benchmark(object):
+    """Time functions, keeping the best of repeat runs, and collect
+       the results by name. If memory is true, each function is run once
+       more under tracemalloc to record its peak memory (the timed runs are
+       not traced, tracemalloc slowing them down)."""
+    def __init__(self, repeat=1, verbose=True, memory=True):
+        self.repeat = repeat
+        self.verbose = verbose
+        self.memory = memory
+        self.results = {}
+    def run(self, name, function, items=None, unit="items", setup=None):
+        """Run function() repeat times (after setup() if given) and record
+           its best time, and its peak memory. items is the number of
+           processed items, or a function of the result of function()."""
+        best = None
+        result = None
+        for i in range(self.repeat):
+            if setup:
+                setup()
+            start = default_timer()
+            result = function()
+            seconds = default_timer() - start
+            best = seconds if best is None else min(best, seconds)
+        count = items(result) if callable(items) else items
+        entry = {"seconds": round(best, 6)}
+        if self.memory:
+            if setup:
+                setup()
+            entry["peak_traced_mb"] = traced_peak_mb(function)
+        if count is not None:
+            entry[unit] = count
+            entry[unit + "_per_second"] = round(count / best, 1) if best > 0 else None
+        self.results[name] = entry
+        if self.verbose:
+            sys.stderr.write("{:45} {:9.3f} s {}\n".format(name, best,
+                "{:12.0f} {}/s".format(entry[unit + "_per_second"], unit) if count else ""))
+        return result
+
+def run_benchmarks(args, work_dir):
+    benchmark = Benchmark(args.repeat, not args.quiet, not args.no_memory)
+    feed_dir = os.path.join(work_dir, "gtfs")
+    start = default_timer()
+    feed = generate_gtfs(feed_dir, args.stops, args.routes, args.patterns, args.trips,
+                         args.stops_per_pattern, args.shape_step, args.seed)
+    if not args.quiet:
+        sys.stderr.write("generated {} in {:.1f} s\n".format(feed, default_timer() - start))
+
+    gtfs = benchmark.run("MyGTFS.__init__", lambda: gtfs_to_osm.MyGTFS(feed_dir),
+                         feed["stop_times.txt"] + feed["shapes.txt"], "rows")
+    gtfs_to_osm.load_gtfs(feed_dir)
+    benchmark.run("load_gtfs (cached)", lambda: gtfs_to_osm.load_gtfs(feed_dir),
+                  feed["stop_times.txt"] + feed["shapes.txt"], "rows")
+
+    lists_of_stops = gtfs.all_lists_of_stops
+    def clear_caches():
+        gtfs.summaries = {}
+        gtfs.schedule_tables = {}
+    for getter in GETTERS:
+        method = getattr(gtfs, getter)
+        dates = (REFERENCE_DATE, REFERENCE_END_DATE) if getter in DATED_GETTERS else ()
+        benchmark.run("MyGTFS." + getter,
+                      lambda: [method(list_of_stops, *dates) for list_of_stops in lists_of_stops],
+                      len(lists_of_stops), "lists_of_stops", setup=clear_caches)
+
+    # write_osm_pseudo_ways calcule les horaires sur MIN_DATE, MAX_DATE
+    gtfs_to_osm.MIN_DATE = REFERENCE_DATE
+    gtfs_to_osm.MAX_DATE = REFERENCE_END_DATE
+    agency = list(gtfs.agency.values())[0]
+    osm_filename = os.path.join(work_dir, "pseudo_ways.osm")
+    benchmark.run("write_osm_pseudo_ways",
+                  lambda: gtfs_to_osm.write_osm_pseudo_ways(gtfs, agency, osm_filename),
+                  lambda counts: sum(counts.values()) if counts else None, "elements")
+
+    def parse():
+        return OsmParser().parse(osm_filename)
+    def elements(osm):
+        return len(osm.nodes) + len(osm.ways) + len(osm.relations)
+    osm_data = benchmark.run("OsmParser.parse", parse, elements, "elements")
+    benchmark.results["OsmParser.parse"]["megabytes"] = round(os.path.getsize(osm_filename) / 1e6, 3)
+    benchmark.run("OsmWriter.write", lambda: OsmWriter(osm_data).write_to_file(os.path.join(work_dir, "written.osm")),
+                  elements(osm_data), "elements")
+    del osm_data
+
+    stops_filename = os.path.join(work_dir, "stops.osm")
+    generate_stops_osm(gtfs, stops_filename, args.seed)
+    refs = sorted(gtfs.lists_of_stops_by_ref)
+    date = REFERENCE_DATE
+    def add_lines():
+        osm_data = OsmParser().parse(stops_filename)
+        stop_matchers = {}
+        for ref in refs:
+            add_line_module.add_line(gtfs, osm_data, ref, date, stop_matchers)
+        return osm_data
+    benchmark.run("add_line", add_lines, len(refs), "lines")
+
+    return {
+        "commit": describe_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "parameters": {
+            "stops": args.stops, "routes": args.routes, "patterns": args.patterns, "trips": args.trips,
+            "stops_per_pattern": args.stops_per_pattern, "shape_step": args.shape_step,
+            "seed": args.seed, "repeat": args.repeat},
+        "feed": feed,
+        "results": benchmark.results,
+    }
+
+def describe_commit():
+    try:
+        return get_git_describe()
+    except Exception:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the GTFS loading and OSM export on a synthetic GTFS feed")
+    parser.add_argument("--stops", type=int, default=2000, help="number of stops")
+    parser.add_argument("--routes", type=int, default=100, help="number of routes")
+    parser.add_argument("--patterns", type=int, default=2, help="lists of stops per route")
+    parser.add_argument("--trips", type=int, default=40, help="trips per list of stops")
+    parser.add_argument("--stops-per-pattern", type=int, default=25, help="stops per list of stops")
+    parser.add_argument("--shape-step", type=float, default=20, help="meters between two shape points")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the random generator")
+    parser.add_argument("--repeat", type=int, default=1, help="keep the best time of this number of runs")
+    parser.add_argument("--no-memory", action="store_true", help="do not run each stage once more to measure its peak memory")
+    parser.add_argument("--keep", metavar="DIR", help="generate the files in DIR and keep them")
+    parser.add_argument("-q", "--quiet", action="store_true", help="do not print the timings on stderr")
+    parser.add_argument("-o", "--output", help="JSON output file (default: stdout)")
+    args = parser.parse_args()
+    work_dir = args.keep or tempfile.mkdtemp(prefix="gtfs_benchmark_")
+    # les messages des fonctions mesurées ne doivent pas se mêler au JSON
+    messages = open(os.devnull, "w") if args.quiet else sys.stderr
+    try:
+        with contextlib.redirect_stdout(messages):
+            report = run_benchmarks(args, work_dir)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
@@ -3,14 +3,24 @@
 import io
 import csv
 import sys
+import math
+import time
 import string
+import hashlib
 import os.path
+import argparse
 import datetime
+import itertools
+import multiprocessing
 import urllib.request
+from array import array
 from zipfile import ZipFile
 from collections import namedtuple, defaultdict
 from pprint import pprint
 
+from tools import load_cached
+from osm import OsmStreamWriter, EARTH_RADIUS
+
 
 """
 Extract some GTFS info to help integrate them in OpenStreetMap
@@ -38,44 +48,47 @@ NETWORK_OF_AGENCY = {
     "TAM": "TaM",
 }
 
+GTFS_CACHE_VERSION = "3"
+
+# Jours indexés dans les bitmaps du calendrier après la dernière date
+# concrète (début de service ou exception) du GTFS: les services qui
+# courent au-delà (end_date=99991231...) sont extrapolés par jour de la
+# semaine au lieu d'allouer un bit par jour jusqu'à leur fin.
+CALENDAR_HORIZON_DAYS = 3 * 366
+
 week_days = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
 
 class MyGTFS(object):
     def __init__(self, path="."):
+        # Les fichiers CSV sont lus en flux: seuls les index construits
+        # ci-dessous sont gardés en mémoire, jamais la liste des lignes.
         if os.path.isfile(path):
             zip_file = ZipFile(path)
             open_file = lambda filename: io.TextIOWrapper(zip_file.open(filename), encoding="utf-8")
         else:
             assert os.path.isdir(path)
-            open_file = lambda filename: open(os.path.join(path, filename))
+            open_file = lambda filename: open(os.path.join(path, filename), encoding="utf-8")
         self.stops = {stop.stop_id : stop for stop in parse_csv(open_file("stops.txt"), "Stop")}
         self.routes = {route.route_id : route for route in parse_csv(open_file("routes.txt"), "Route")}
         self.trips = {trip.trip_id : trip for trip in parse_csv(open_file("trips.txt"), "Trip")}
-        self.stop_times = parse_csv(open_file("stop_times.txt"), "StopTime")
+        self.stop_times = StopTimes(parse_csv(open_file("stop_times.txt"), "StopTime"))
         try:
             self.services = {service.service_id : service for service in parse_csv(open_file("calendar.txt"), "Calendar")}
         except Exception as e:
             print(e)
             self.services = {}
+        try:
+            calendar_dates = list(parse_csv(open_file("calendar_dates.txt"), "CalendarDate"))
+        except Exception as e:
+            print(e)
+            calendar_dates = []
+        self.calendar = ServiceCalendar(self.services.values(), calendar_dates)
         self.agency = {agency.agency_id : agency for agency in parse_csv(open_file("agency.txt"), "Agency")}
-        self.shapes = {}
         try:
-            for point in parse_csv(open_file("shapes.txt"), "Shape"):
-                if point.shape_id not in self.shapes:
-                    self.shapes[point.shape_id] = []
-                self.shapes[point.shape_id].append(point)
+            self.shapes = parse_shapes(parse_csv(open_file("shapes.txt"), "Shape"))
         except:
-            pass
-        for shape in self.shapes.values():
-            shape.sort(key=lambda point:int(point.shape_pt_sequence))
-
-        self.stop_times_by_trip_id = {}
-        for stop_time in self.stop_times:
-            if stop_time.trip_id not in self.stop_times_by_trip_id:
-                self.stop_times_by_trip_id[stop_time.trip_id] = []
-            self.stop_times_by_trip_id[stop_time.trip_id].append(stop_time)
-        for stop_time_list in self.stop_times_by_trip_id.values():
-            stop_time_list.sort(key=lambda stop_time:int(stop_time.stop_sequence))
+            self.shapes = {}
+
 
         self.trips_by_list_of_stops = {}
         for trip in self.trips.values():
@@ -85,34 +98,101 @@ class MyGTFS(object):
             self.trips_by_list_of_stops[trip_stops].add(trip.trip_id)
 
         self.all_lists_of_stops = sorted(self.trips_by_list_of_stops.keys())
+        self.schedule_tables = {}
+        self.summaries = {}
+
+        # Index inverses pour éviter de parcourir tous les trips à chaque requête
+        self.route_types_by_shape_id = defaultdict(set)
+        for trip in self.trips.values():
+            # shape_id est optionnel dans trips.txt
+            shape_id = getattr(trip, "shape_id", "")
+            if shape_id:
+                self.route_types_by_shape_id[shape_id].add(self.routes[trip.route_id].route_type)
+        self.routes_ids_by_list_of_stops = {}
+        self.agencies_ids_by_list_of_stops = {}
+        self.services_ids_by_list_of_stops = {}
+        self.lists_of_stops_by_ref = defaultdict(list)
+        for list_of_stops in self.all_lists_of_stops:
+            trips = [self.trips[trip_id] for trip_id in self.trips_by_list_of_stops[list_of_stops]]
+            routes_ids = set([trip.route_id for trip in trips])
+            self.routes_ids_by_list_of_stops[list_of_stops] = routes_ids
+            self.agencies_ids_by_list_of_stops[list_of_stops] = set([
+                self.routes[route_id].agency_id for route_id in routes_ids])
+            self.services_ids_by_list_of_stops[list_of_stops] = set([trip.service_id for trip in trips])
+            for ref in set([self.routes[route_id].route_short_name for route_id in routes_ids]):
+                self.lists_of_stops_by_ref[ref].append(list_of_stops)
+
+    def __getstate__(self):
+        # Uniquement des types de base dans l'état, pour que le cache soit
+        # lisible depuis gtfs_to_osm.py comme depuis add-line.py (les
+        # namedtuple sont créés dynamiquement par parse_csv).
+        state = dict(self.__dict__)
+        for name in ("stops", "routes", "trips", "services", "agency"):
+            state[name] = dump_namedtuples(state[name])
+        state["shapes"] = {shape_id: (shape.lons, shape.lats, shape.distances)
+                           for shape_id, shape in self.shapes.items()}
+        state["stop_times"] = dict(self.stop_times.__dict__)
+        state["calendar"] = dict(self.calendar.__dict__)
+        state["schedule_tables"] = {}
+        state["summaries"] = {}
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        for name in ("stops", "routes", "trips", "services", "agency"):
+            state[name] = load_namedtuples(state[name])
+        state["shapes"] = {shape_id: ShapePoints(*shape) for shape_id, shape in state["shapes"].items()}
+        stop_times = StopTimes.__new__(StopTimes)
+        stop_times.__dict__.update(state["stop_times"])
+        state["stop_times"] = stop_times
+        calendar = ServiceCalendar.__new__(ServiceCalendar)
+        calendar.__dict__.update(state["calendar"])
+        state["calendar"] = calendar
+        self.__dict__.update(state)
 
     def trip_stops_ids(self, trip_id):
-        trip_stop_times = self.stop_times_by_trip_id[trip_id]
-        return tuple([stop_time.stop_id for stop_time in trip_stop_times])
+        return self.stop_times.trip_stops_ids(trip_id)
+
+    def get_summary(self, list_of_stops):
+        """Return the Summary of a list of stops, computed on first use."""
+        summary = self.summaries.get(list_of_stops)
+        if summary is None:
+            summary = self.compute_summary(list_of_stops)
+            self.summaries[list_of_stops] = summary
+        return summary
+
+    def compute_summary(self, list_of_stops):
+        routes = [self.routes[route_id] for route_id in self.routes_ids_by_list_of_stops[list_of_stops]]
+        services_ids = sorted(self.services_ids_by_list_of_stops[list_of_stops])
+        start_dates = [self.calendar.first_date(sid) for sid in services_ids]
+        start_dates = [date for date in start_dates if date is not None]
+        end_dates = [self.calendar.last_date(sid) for sid in services_ids]
+        end_dates = [date for date in end_dates if date is not None]
+        return Summary(
+            ref=";".join(sorted(set([route.route_short_name for route in routes]))),
+            route_type=";".join(sorted(set([route.route_type for route in routes]))),
+            agency=";".join(sorted(set([
+                self.agency[agency_id].agency_name
+                for agency_id in self.agencies_ids_by_list_of_stops[list_of_stops]]))),
+            name=";".join(sorted(set([route.route_long_name for route in routes]))),
+            headsign=";".join(sorted(set([
+                self.trips[trip_id].trip_headsign
+                for trip_id in self.trips_by_list_of_stops[list_of_stops]]))),
+            services_ids=tuple(services_ids),
+            start_date=min(start_dates) if start_dates else datetime.date.today(),
+            end_date=max(end_dates) if end_dates else datetime.date.today())
 
     def get_ref_from_list_of_stops(self, list_of_stops):
-        refs = set([
-            self.routes[self.trips[trip_id].route_id].route_short_name
-            for trip_id in self.trips_by_list_of_stops[list_of_stops]])
-        return ";".join(sorted(refs))
+        return self.get_summary(list_of_stops).ref
 
     def get_route_type(self, list_of_stops):
-        route_types = set([
-            self.routes[self.trips[trip_id].route_id].route_type
-            for trip_id in self.trips_by_list_of_stops[list_of_stops]])
-        return ";".join(sorted(route_types))
+        return self.get_summary(list_of_stops).route_type
 
     def get_agency(self, list_of_stops):
-        agencies_name = set([
-            self.agency[self.routes[self.trips[trip_id].route_id].agency_id].agency_name
-            for trip_id in self.trips_by_list_of_stops[list_of_stops]])
-        return ";".join(sorted(agencies_name))
+        return self.get_summary(list_of_stops).agency
 
     def get_shape_route_type(self, shape_id):
-        route_types = set([
-            self.routes[trip.route_id].route_type
-            for trip in self.trips.values() if trip.shape_id == shape_id])
-        return ";".join(sorted(route_types))
+        return ";".join(sorted(self.route_types_by_shape_id.get(shape_id, ())))
 
     def get_route_colour(self, list_of_stops):
         route_colours = set([
@@ -121,110 +201,44 @@ class MyGTFS(object):
         return ";".join(sorted(route_colours))
 
     def get_name_from_list_of_stops(self, list_of_stops):
-        names = set([
-            self.routes[self.trips[trip_id].route_id].route_long_name
-            for trip_id in self.trips_by_list_of_stops[list_of_stops]])
-        return ";".join(sorted(names))
+        return self.get_summary(list_of_stops).name
 
     def get_headsign_from_list_of_stops(self, list_of_stops):
-        headsigns = set([
-            self.trips[trip_id].trip_headsign
-            for trip_id in self.trips_by_list_of_stops[list_of_stops]])
-        return ";".join(sorted(headsigns))
+        return self.get_summary(list_of_stops).headsign
 
     def get_services_ids_from_list_of_stops(self, list_of_stops):
-        return sorted(set([
-            self.trips[trip_id].service_id
-            for trip_id in self.trips_by_list_of_stops[list_of_stops]]))
+        return list(self.get_summary(list_of_stops).services_ids)
 
     def get_start_date_from_list_of_stops(self, list_of_stops):
-        services_list = [self.services[sid] for sid in self.get_services_ids_from_list_of_stops(list_of_stops) if sid in self.services]
-        if len(services_list):
-            return min([parse_date(service.start_date) for service in services_list])
-        else:
-            return datetime.date.today()
+        return self.get_summary(list_of_stops).start_date
 
     def get_end_date_from_list_of_stops(self, list_of_stops):
-        services_list = [self.services[sid] for sid in self.get_services_ids_from_list_of_stops(list_of_stops) if sid in self.services]
-        if len(services_list):
-            return max([parse_date(service.start_date) for service in services_list])
-        else:
-            return datetime.date.today()
+        return self.get_summary(list_of_stops).end_date
 
     def is_trip_serviced_on_day(self, trip_id, day, start_date=MIN_DATE, end_date=MAX_DATE):
+        """Return True if the trip runs on a week day named day between start_date
+           and end_date (included). Trips whose service is in neither calendar.txt
+           nor calendar_dates.txt are considered as running every day.
+        """
+        days_mask = self.get_trip_days_mask(trip_id, start_date, end_date)
+        return bool(days_mask & (1 << week_days.index(day)))
+
+    def get_trip_days_mask(self, trip_id, start_date=MIN_DATE, end_date=MAX_DATE):
+        """Return a week days bitmask (bit i for week_days[i]) of the days on which
+           the trip runs between start_date and end_date.
+        """
         service_id = self.trips[trip_id].service_id
-        if service_id in self.services:
-            service = self.services[self.trips[trip_id].service_id]
-            return (getattr(service, day)) == "1" \
-                and parse_date(service.start_date) <= end_date \
-                and parse_date(service.end_date) >= start_date
+        if service_id in self.calendar:
+            return self.calendar.week_days_mask(service_id, start_date, end_date)
         else:
-            return True
+            return (1 << len(week_days)) - 1
 
-    def get_duration_from_list_of_stops(self, list_of_stops, date=None):
-        durations = []
-        for trip_id in self.trips_by_list_of_stops[list_of_stops]:
-            trip_departure_time = min([
-                parse_time(stop_time.departure_time)
-                for stop_time in self.stop_times_by_trip_id[trip_id]])
-            trip_arrival_time = max([
-                parse_time(stop_time.arrival_time)
-                for stop_time in self.stop_times_by_trip_id[trip_id]])
-            durations.append((trip_arrival_time - trip_departure_time))
-        total_duration = datetime.timedelta(0)
-        for d in durations:
-            total_duration = total_duration + d
-
-        # j'ai le sentiment que durée moyenne du trajet n'est pas
-        # représentative car:
-        # - les moments où le bus vas vite c'est en général ou il a peu de voyageur
-        # - les moment ou il vas lentement c'est en général ou il est blindé
-        # Je pense qu'en moyenne plus de gens prennent le bus qand il est lent
-        # que quand il est rapide.
-
-        # Pour avoir un truc plus représentatif, je donne comme durée
-        # la moyenne entre la durée moyenne et la durée maximale:
-
-        mean_duration = total_duration / len(durations)
-        max_duration = max(durations)
-        duration = (mean_duration + max_duration) / 2
-        return format_time(duration)
+    def get_duration_from_list_of_stops(self, list_of_stops, start_date=MIN_DATE, end_date=MAX_DATE):
+        return self.get_schedule_table(start_date, end_date)[list_of_stops].duration
 
     def get_interval_from_list_of_stops(self, list_of_stops, start_date=MIN_DATE, end_date=MAX_DATE):
-        total_interval = datetime.timedelta(0)
-        interval_count = 0
-        for day in week_days:
-            #print()
-            #print(day)
-            departure_times_of_day = sorted([
-                min([
-                    parse_time(stop_time.departure_time)
-                    for stop_time in self.stop_times_by_trip_id[trip_id]])
-                for trip_id in self.trips_by_list_of_stops[list_of_stops]
-                if self.is_trip_serviced_on_day(trip_id, day, start_date, end_date)
-                ])
-            if len(departure_times_of_day) > 1:
-                total_interval += departure_times_of_day[-1] - departure_times_of_day[0]
-                interval_count += len(departure_times_of_day) - 1
-                #for time in departure_times_of_day:
-                #    print(time)
-                #last_interval_start = departure_times_of_day[0]
-                #last_interval = departure_times_of_day[1] - departure_times_of_day[0]
-                #previous_time  = departure_times_of_day[1]
-                #for time in departure_times_of_day[2:]:
-                #    interval = time - previous_time
-                #    if interval != last_interval:
-                #        print(last_interval, "@", last_interval_start ,"-", previous_time)
-                #        last_interval = interval
-                #        last_interval_start = previous_time
-                #    previous_time = time
-                #print(last_interval, "@", last_interval_start ,"-", previous_time)
-
-        if interval_count:
-            # retourne la moyenne, je ne sais pas si c'est représentatif
-            return format_time(total_interval / interval_count), None
-        else:
-            return None, None
+        schedule = self.get_schedule_table(start_date, end_date)[list_of_stops]
+        return schedule.interval, schedule.interval_conditional
 
     def get_opening_hours_from_list_of_stops(self, list_of_stops, start_date=MIN_DATE, end_date=MAX_DATE):
         """
@@ -233,56 +247,57 @@ class MyGTFS(object):
         comme expliqué sur cette page:
             https://wiki.openstreetmap.org/wiki/Buses
         """
-        opening_hours_by_day = {}
-        for day in week_days:
-            departure_times_of_day = sorted([
-                min([
-                    parse_time(stop_time.departure_time)
-                    for stop_time in self.stop_times_by_trip_id[trip_id]])
-                for trip_id in self.trips_by_list_of_stops[list_of_stops]
-                if self.is_trip_serviced_on_day(trip_id, day, start_date, end_date)
-                ])
-            arrival_times_of_day = sorted([
-                max([
-                    parse_time(stop_time.arrival_time)
-                    for stop_time in self.stop_times_by_trip_id[trip_id]])
-                for trip_id in self.trips_by_list_of_stops[list_of_stops]
-                if self.is_trip_serviced_on_day(trip_id, day, start_date, end_date)
-                ])
-            if departure_times_of_day:# and arrival_times_of_day:
-                opening_hours_by_day[day] = \
-                        format_time(departure_times_of_day[0])[:5] \
-                        + "-" \
-                        + format_time(departure_times_of_day[-1])[:5]
-                        #+ format_time(arrival_times_of_day[-1])[:5]
-            else:
-                opening_hours_by_day[day] = None
-        opening_hours_list = None
-        for day in week_days:
-            if opening_hours_by_day[day]:
-                opening_hours_list = [[[day,day], opening_hours_by_day[day]]]
-                previous_day = day
-                break
-        if opening_hours_list:
-            for day in week_days[1:]:
-                if opening_hours_by_day[day]:
-                    if opening_hours_by_day[day] == opening_hours_list[-1][1] \
-                            and previous_day == opening_hours_list[-1][0][1]:
-                        opening_hours_list[-1][0][1] = day
+        return self.get_schedule_table(start_date, end_date)[list_of_stops].opening_hours
+
+    def get_schedule_table(self, start_date=MIN_DATE, end_date=MAX_DATE):
+        """Return a dict list_of_stops -> Schedule for all the lists of stops,
+           computed once per (start_date, end_date) in a single pass over
+           the trips.
+        """
+        key = (start_date, end_date)
+        if key not in self.schedule_tables:
+            self.schedule_tables[key] = self.compute_schedule_table(start_date, end_date)
+        return self.schedule_tables[key]
+
+    def compute_schedule_table(self, start_date=MIN_DATE, end_date=MAX_DATE):
+        days_mask_by_service_id = {}
+        return {
+            list_of_stops: self.compute_schedule(list_of_stops, start_date, end_date, days_mask_by_service_id)
+            for list_of_stops in self.trips_by_list_of_stops}
+
+    def compute_schedule(self, list_of_stops, start_date=MIN_DATE, end_date=MAX_DATE, days_mask_by_service_id=None):
+        """Return the Schedule of one list of stops. days_mask_by_service_id
+           caches the week days masks between calls.
+        """
+        if days_mask_by_service_id is None:
+            days_mask_by_service_id = {}
+        durations = []
+        first_departures = [None] * len(week_days)
+        last_departures = [None] * len(week_days)
+        departures_count = [0] * len(week_days)
+        for trip_id in self.trips_by_list_of_stops[list_of_stops]:
+            departure = self.stop_times.trip_departure_time(trip_id)
+            durations.append(self.stop_times.trip_arrival_time(trip_id) - departure)
+            service_id = self.trips[trip_id].service_id
+            days_mask = days_mask_by_service_id.get(service_id)
+            if days_mask is None:
+                days_mask = self.get_trip_days_mask(trip_id, start_date, end_date)
+                days_mask_by_service_id[service_id] = days_mask
+            for day_index in range(len(week_days)):
+                if days_mask & (1 << day_index):
+                    if departures_count[day_index] == 0:
+                        first_departures[day_index] = departure
+                        last_departures[day_index] = departure
                     else:
-                        opening_hours_list.append([[day,day], opening_hours_by_day[day]])
-                previous_day = day
-            # Use coma "," separator for opening hours because they may pass the end
-            # of the day and then overlap the following days.
-            opening_hours = ";".join([
-                    (day_short_name[oh[0][0]] if oh[0][0] == oh[0][1]
-                    else day_short_name[oh[0][0]] + "-" + day_short_name[oh[0][1]])
-                    + " "
-                    + oh[1]
-                    for oh in opening_hours_list])
-            return opening_hours + ";May 1 off"
-        else:
-            return "off"
+                        first_departures[day_index] = min(first_departures[day_index], departure)
+                        last_departures[day_index] = max(last_departures[day_index], departure)
+                    departures_count[day_index] += 1
+        return Schedule(
+            format_duration(durations),
+            format_interval(first_departures, last_departures, departures_count),
+            None,
+            format_opening_hours(first_departures, last_departures))
+
     def get_osm_name_from_list_of_stops(self, list_of_stops, prefix="", extension="", only_to=False):
         route_type = self.get_route_type(list_of_stops)
         ref = self.get_ref_from_list_of_stops(list_of_stops)
@@ -297,6 +312,368 @@ class MyGTFS(object):
                 + (self.stops[list_of_stops[-1]].stop_name if list_of_stops[-1] in self.stops else "?")
         return osm_name
 
+
+class ServiceCalendar(object):
+    """
+    Days on which each service runs, built once from calendar.txt and the
+    exceptions of calendar_dates.txt.
+
+    Each service is a bitmap (a python int) over the validity window of
+    the feed: bit i is set if the service runs on first_day + i days.
+    The window ends CALENDAR_HORIZON_DAYS after the last start_date or
+    calendar_dates date; after it there is no exception any more, and the
+    services running further are kept in open_services as their days of
+    the week and end day.
+    """
+    def __init__(self, services, calendar_dates):
+        services = list(services)
+        calendar_dates = list(calendar_dates)
+        concrete_days = [parse_date(service.start_date).toordinal() for service in services] \
+            + [parse_date(calendar_date.date).toordinal() for calendar_date in calendar_dates]
+        days = concrete_days + [parse_date(service.end_date).toordinal() for service in services]
+        if days:
+            self.first_day = min(days)
+            self.days_count = min(max(days), max(concrete_days) + CALENDAR_HORIZON_DAYS) - self.first_day + 1
+        else:
+            self.first_day = datetime.date.today().toordinal()
+            self.days_count = 0
+        # Masque des jours de la fenêtre qui tombent sur chaque jour de la semaine
+        self.week_day_masks = []
+        for week_day in range(len(week_days)):
+            first_bit = (week_day - datetime.date.fromordinal(self.first_day).weekday()) % 7
+            self.week_day_masks.append(int("".join(
+                "1" if (i % 7) == first_bit else "0"
+                for i in reversed(range(self.days_count))) or "0", 2))
+        self.bitmaps = {}
+        self.open_services = {}
+        for service in services:
+            start = parse_date(service.start_date).toordinal() - self.first_day
+            end = parse_date(service.end_date).toordinal() - self.first_day
+            bitmap = 0
+            service_week_days = 0
+            for week_day, day in enumerate(week_days):
+                if getattr(service, day) == "1":
+                    bitmap |= self.week_day_masks[week_day]
+                    service_week_days |= 1 << week_day
+            self.bitmaps[service.service_id] = bitmap & self.range_mask(start, end)
+            if end >= self.days_count and service_week_days:
+                self.open_services[service.service_id] = (service_week_days, self.first_day + end)
+        for calendar_date in calendar_dates:
+            bit = 1 << (parse_date(calendar_date.date).toordinal() - self.first_day)
+            bitmap = self.bitmaps.get(calendar_date.service_id, 0)
+            if calendar_date.exception_type == "1":
+                self.bitmaps[calendar_date.service_id] = bitmap | bit
+            elif calendar_date.exception_type == "2":
+                self.bitmaps[calendar_date.service_id] = bitmap & ~bit
+
+    def __contains__(self, service_id):
+        return service_id in self.bitmaps
+
+    def range_mask(self, start, end):
+        """Bitmask of the days with index between start and end (included)."""
+        start = max(start, 0)
+        end = min(end, self.days_count - 1)
+        if start > end:
+            return 0
+        return ((1 << (end - start + 1)) - 1) << start
+
+    def dates_mask(self, start_date, end_date):
+        return self.range_mask(start_date.toordinal() - self.first_day, end_date.toordinal() - self.first_day)
+
+    def open_week_days_mask(self, service_id, start_day, end_day):
+        """Bitmask of the days of the week on which the service runs between
+           the ordinals start_day and end_day (included), after the window."""
+        if service_id not in self.open_services:
+            return 0
+        service_week_days, service_end_day = self.open_services[service_id]
+        start_day = max(start_day, self.first_day + self.days_count)
+        end_day = min(end_day, service_end_day)
+        if end_day - start_day >= 6:
+            return service_week_days
+        return sum([
+            1 << datetime.date.fromordinal(day).weekday()
+            for day in range(start_day, end_day + 1)]) & service_week_days
+
+    def is_serviced(self, service_id, date):
+        index = date.toordinal() - self.first_day
+        if index >= self.days_count:
+            return bool(self.open_week_days_mask(service_id, date.toordinal(), date.toordinal()))
+        return 0 <= index and bool(self.bitmaps.get(service_id, 0) >> index & 1)
+
+    def is_serviced_between(self, service_id, start_date, end_date):
+        return bool(self.bitmaps.get(service_id, 0) & self.dates_mask(start_date, end_date)) \
+            or bool(self.open_week_days_mask(service_id, start_date.toordinal(), end_date.toordinal()))
+
+    def week_days_mask(self, service_id, start_date, end_date):
+        """Return a bitmask with bit i set if the service runs on a week_days[i]
+           between start_date and end_date (included)."""
+        bitmap = self.bitmaps.get(service_id, 0) & self.dates_mask(start_date, end_date)
+        return sum([
+            1 << week_day
+            for week_day, week_day_mask in enumerate(self.week_day_masks)
+            if bitmap & week_day_mask]) \
+            | self.open_week_days_mask(service_id, start_date.toordinal(), end_date.toordinal())
+
+    def first_date(self, service_id):
+        bitmap = self.bitmaps.get(service_id, 0)
+        if bitmap:
+            return datetime.date.fromordinal(self.first_day + (bitmap & -bitmap).bit_length() - 1)
+        start_day = self.first_day + self.days_count
+        for day in range(start_day, start_day + 7):
+            if self.open_week_days_mask(service_id, day, day):
+                return datetime.date.fromordinal(day)
+        return None
+
+    def last_date(self, service_id):
+        if service_id in self.open_services:
+            service_end_day = self.open_services[service_id][1]
+            for day in range(service_end_day, service_end_day - 7, -1):
+                if self.open_week_days_mask(service_id, day, day):
+                    return datetime.date.fromordinal(day)
+        bitmap = self.bitmaps.get(service_id, 0)
+        if bitmap:
+            return datetime.date.fromordinal(self.first_day + bitmap.bit_length() - 1)
+        else:
+            return None
+
+
+class ShapePoints(object):
+    """
+    Points of a shape, sorted by shape_pt_sequence, as float arrays of
+    longitudes and latitudes, and of shape_dist_traveled (None when the
+    column is missing, nan for an empty value).
+    """
+    __slots__ = ("lons", "lats", "distances")
+
+    def __init__(self, lons, lats, distances=None):
+        self.lons = lons
+        self.lats = lats
+        self.distances = distances
+
+    def __len__(self):
+        return len(self.lons)
+
+    def __iter__(self):
+        """Iterate over the (lon, lat) of the points."""
+        return zip(self.lons, self.lats)
+
+def parse_shapes(points):
+    """Return a dict shape_id -> ShapePoints of shapes.txt rows."""
+    columns_by_shape_id = {}
+    last_shape_id = None
+    for point in points:
+        if last_shape_id is None:
+            # index des colonnes, plus rapide que les attributs du namedtuple
+            fields = point._fields
+            shape_id_index = fields.index("shape_id")
+            sequence_index = fields.index("shape_pt_sequence")
+            lon_index = fields.index("shape_pt_lon")
+            lat_index = fields.index("shape_pt_lat")
+            distance_index = fields.index("shape_dist_traveled") if "shape_dist_traveled" in fields else None
+        shape_id = point[shape_id_index]
+        if shape_id != last_shape_id:
+            # les points d'une shape se suivent en général dans le fichier
+            columns = columns_by_shape_id.get(shape_id)
+            if columns is None:
+                columns = (array("l"), array("d"), array("d"), None if distance_index is None else array("d"))
+                columns_by_shape_id[shape_id] = columns
+            sequences, lons, lats, distances = columns
+            last_shape_id = shape_id
+        sequences.append(int(point[sequence_index]))
+        lons.append(float(point[lon_index]))
+        lats.append(float(point[lat_index]))
+        if distances is not None:
+            distance = point[distance_index]
+            distances.append(float(distance) if distance else float("nan"))
+    shapes = {}
+    for shape_id, (sequences, lons, lats, distances) in columns_by_shape_id.items():
+        if any(sequences[i] > sequences[i + 1] for i in range(len(sequences) - 1)):
+            order = sorted(range(len(sequences)), key=sequences.__getitem__)
+            lons = array("d", [lons[i] for i in order])
+            lats = array("d", [lats[i] for i in order])
+            if distances is not None:
+                distances = array("d", [distances[i] for i in order])
+        shapes[shape_id] = ShapePoints(lons, lats, distances)
+    return shapes
+
+
+class StopTimes(object):
+    """
+    Columnar storage of stop_times.txt.
+
+    stop_id and trip_id are interned as integer codes, times are stored
+    as integer seconds and the stop_times of a trip are a contiguous
+    range [trip_start[trip], trip_start[trip + 1]) sorted by stop_sequence.
+    """
+    def __init__(self, stop_times):
+        self.stop_ids = []
+        self.stop_code_by_id = {}
+        self.trip_ids = []
+        self.trip_code_by_id = {}
+        trips = array("i")
+        sequences = array("i")
+        self.stops = array("i")
+        self.arrivals = array("i")
+        self.departures = array("i")
+        for stop_time in stop_times:
+            trips.append(self._intern(self.trip_ids, self.trip_code_by_id, stop_time.trip_id))
+            sequences.append(int(stop_time.stop_sequence))
+            self.stops.append(self._intern(self.stop_ids, self.stop_code_by_id, stop_time.stop_id))
+            self.arrivals.append(parse_seconds(stop_time.arrival_time))
+            self.departures.append(parse_seconds(stop_time.departure_time))
+        self._sort_by_trip(trips, sequences)
+        # Premier départ et dernière arrivée de chaque trip, calculés
+        # une seule fois ici plutôt qu'à chaque requête sur les horaires.
+        self.first_departures = array("i", [
+            min(self.departures[self.trip_start[trip]:self.trip_start[trip + 1]])
+            for trip in range(len(self.trip_ids))])
+        self.last_arrivals = array("i", [
+            max(self.arrivals[self.trip_start[trip]:self.trip_start[trip + 1]])
+            for trip in range(len(self.trip_ids))])
+
+    @staticmethod
+    def _intern(values, code_by_value, value):
+        code = code_by_value.get(value)
+        if code is None:
+            code = len(values)
+            code_by_value[value] = code
+            values.append(value)
+        return code
+
+    def _sort_by_trip(self, trips, sequences):
+        # Tri par dénombrement sur trip puis tri de chaque trip sur
+        # stop_sequence, pour ne pas allouer une liste de clés par ligne.
+        counts = array("q", bytes(8 * (len(self.trip_ids) + 1)))
+        for trip in trips:
+            counts[trip + 1] += 1
+        for trip in range(len(self.trip_ids)):
+            counts[trip + 1] += counts[trip]
+        self.trip_start = counts
+        already_sorted = all(trips[i] <= trips[i + 1] for i in range(len(trips) - 1))
+        if already_sorted:
+            order = None
+        else:
+            order = array("q", bytes(8 * len(trips)))
+            fill = array("q", counts[:-1])
+            for i, trip in enumerate(trips):
+                order[fill[trip]] = i
+                fill[trip] += 1
+        for trip in range(len(self.trip_ids)):
+            start, end = counts[trip], counts[trip + 1]
+            if order is None:
+                indexes = range(start, end)
+            else:
+                indexes = order[start:end]
+            trip_sequences = [sequences[i] for i in indexes]
+            if any(trip_sequences[i] > trip_sequences[i + 1] for i in range(len(trip_sequences) - 1)):
+                if order is None:
+                    order = array("q", range(len(trips)))
+                order[start:end] = array("q", sorted(indexes, key=lambda i: sequences[i]))
+        if order is not None:
+            self.stops = array("i", (self.stops[i] for i in order))
+            self.arrivals = array("i", (self.arrivals[i] for i in order))
+            self.departures = array("i", (self.departures[i] for i in order))
+
+    def __len__(self):
+        return len(self.stops)
+
+    def trip_range(self, trip_id):
+        trip = self.trip_code_by_id[trip_id]
+        return self.trip_start[trip], self.trip_start[trip + 1]
+
+    def trip_stops_ids(self, trip_id):
+        start, end = self.trip_range(trip_id)
+        return tuple([self.stop_ids[stop] for stop in self.stops[start:end]])
+
+    def trip_arrival_times(self, trip_id):
+        start, end = self.trip_range(trip_id)
+        return self.arrivals[start:end]
+
+    def trip_departure_times(self, trip_id):
+        start, end = self.trip_range(trip_id)
+        return self.departures[start:end]
+
+    def trip_departure_time(self, trip_id):
+        return self.first_departures[self.trip_code_by_id[trip_id]]
+
+    def trip_arrival_time(self, trip_id):
+        return self.last_arrivals[self.trip_code_by_id[trip_id]]
+
+Summary = namedtuple("Summary", ["ref", "route_type", "agency", "name", "headsign", "services_ids", "start_date", "end_date"])
+
+Schedule = namedtuple("Schedule", ["duration", "interval", "interval_conditional", "opening_hours"])
+
+def format_duration(durations):
+    """durations: durées en secondes des trips d'une même liste d'arrêts"""
+    total_duration = datetime.timedelta(seconds=sum(durations))
+
+    # j'ai le sentiment que durée moyenne du trajet n'est pas
+    # représentative car:
+    # - les moments où le bus vas vite c'est en général ou il a peu de voyageur
+    # - les moment ou il vas lentement c'est en général ou il est blindé
+    # Je pense qu'en moyenne plus de gens prennent le bus qand il est lent
+    # que quand il est rapide.
+
+    # Pour avoir un truc plus représentatif, je donne comme durée
+    # la moyenne entre la durée moyenne et la durée maximale:
+
+    mean_duration = total_duration / len(durations)
+    max_duration = datetime.timedelta(seconds=max(durations))
+    duration = (mean_duration + max_duration) / 2
+    return format_time(duration)
+
+def format_interval(first_departures, last_departures, departures_count):
+    """Paramètres indexés comme week_days, heures en secondes."""
+    total_interval = 0
+    interval_count = 0
+    for day_index in range(len(week_days)):
+        if departures_count[day_index] > 1:
+            total_interval += last_departures[day_index] - first_departures[day_index]
+            interval_count += departures_count[day_index] - 1
+    if interval_count:
+        # retourne la moyenne, je ne sais pas si c'est représentatif
+        return format_time(datetime.timedelta(seconds=total_interval) / interval_count)
+    else:
+        return None
+
+def format_opening_hours(first_departures, last_departures):
+    """Paramètres indexés comme week_days, heures en secondes."""
+    opening_hours_by_day = {}
+    for day_index, day in enumerate(week_days):
+        if first_departures[day_index] is not None:
+            opening_hours_by_day[day] = \
+                    format_seconds(first_departures[day_index])[:5] \
+                    + "-" \
+                    + format_seconds(last_departures[day_index])[:5]
+        else:
+            opening_hours_by_day[day] = None
+    opening_hours_list = None
+    for day in week_days:
+        if opening_hours_by_day[day]:
+            opening_hours_list = [[[day,day], opening_hours_by_day[day]]]
+            previous_day = day
+            break
+    if opening_hours_list:
+        for day in week_days[1:]:
+            if opening_hours_by_day[day]:
+                if opening_hours_by_day[day] == opening_hours_list[-1][1] \
+                        and previous_day == opening_hours_list[-1][0][1]:
+                    opening_hours_list[-1][0][1] = day
+                else:
+                    opening_hours_list.append([[day,day], opening_hours_by_day[day]])
+            previous_day = day
+        # Use coma "," separator for opening hours because they may pass the end
+        # of the day and then overlap the following days.
+        opening_hours = ";".join([
+                (day_short_name[oh[0][0]] if oh[0][0] == oh[0][1]
+                else day_short_name[oh[0][0]] + "-" + day_short_name[oh[0][1]])
+                + " "
+                + oh[1]
+                for oh in opening_hours_list])
+        return opening_hours + ";May 1 off"
+    else:
+        return "off"
+
 route_type_name = {
     "0" : "Tram",
     "1" : "Métro",
@@ -347,218 +724,723 @@ def parse_date(date_str):
     )
 
 def parse_time(time_str):
+    return datetime.timedelta(seconds=parse_seconds(time_str))
+
+def parse_seconds(time_str):
     if time_str:
         hours, minutes, seconds = map(int, time_str.split(":"))
-        return datetime.timedelta(hours=hours, minutes=minutes, seconds=seconds)
+        return hours * 3600 + minutes * 60 + seconds
     else:
-        return datetime.timedelta(hours=0, minutes=0, seconds=0)
+        return 0
 
 
 def format_time(timedelta):
-    hours = timedelta.seconds // 3600
-    minutes = (timedelta.seconds // 60) % 60
-    seconds = timedelta.seconds % 60
+    return format_seconds(timedelta.seconds)
+
+def format_seconds(time_seconds):
+    time_seconds = int(time_seconds) % (24 * 3600)
+    hours = time_seconds // 3600
+    minutes = (time_seconds // 60) % 60
+    seconds = time_seconds % 60
     return "{:02d}:{:02d}:{:02d}".format(hours,minutes,seconds)
 
 def format_date(date):
     return "{:04d}-{:02d}-{:02d}".format(date.year, date.month, date.day)
 
 
-def write_osm_pseudo_ways(gtfs, agency, osm_filename):
+def stop_tags(stop, agency):
+    return {
+        "highway": "bus_stop",
+        "public_transport": "platform",
+        "bus": "yes",
+        "source": SOURCE_ATTRIBUTE_OF_AGENCY.get(agency.agency_name,""),
+        "source:date": str(MIN_DATE),
+        "name": stop.stop_name,
+        "stop_id": stop.stop_id,
+        "ref": stop.stop_code,
+        REF_ATTRIBUTE_OF_AGENCY.get(agency.agency_name, "ref"): stop.stop_code,
+    }
+
+RouteRecord = namedtuple("RouteRecord", ["list_of_stops", "ref", "route_tag", "route_master_name", "agency", "tags", "shapes_ids"])
+
+def compute_route_record(gtfs, list_of_stops, days_mask_by_service_id=None):
+    """Return the RouteRecord of a list of stops: all the content of its
+       route relation but the OSM ids of the members, which are given when
+       it is written. gtfs is only read.
+    """
+    schedule = gtfs.compute_schedule(list_of_stops, MIN_DATE, MAX_DATE, days_mask_by_service_id)
+    ref = gtfs.get_ref_from_list_of_stops(list_of_stops)
+    route_type = gtfs.get_route_type(list_of_stops)
+    route_name = gtfs.get_osm_name_from_list_of_stops(list_of_stops)
+    official_name = gtfs.get_name_from_list_of_stops(list_of_stops)
+    tags = {
+        "name": route_name,
+        "official_name": official_name,
+        "description": gtfs.get_headsign_from_list_of_stops(list_of_stops),
+        "ref": ref,
+        "type": "route",
+        "route": route_type_route_tag[route_type],
+        "oneway": "yes",
+        "duration": schedule.duration,
+        "start_date": format_date(gtfs.get_start_date_from_list_of_stops(list_of_stops)),
+        "end_date": format_date(gtfs.get_end_date_from_list_of_stops(list_of_stops)),
+        "operator": gtfs.get_agency(list_of_stops),
+        "public_transport:version": "2",
+    }
+    if schedule.interval:
+        tags["interval"] = schedule.interval
+    if schedule.interval_conditional:
+        tags["interval:conditional"] = schedule.interval_conditional
+    tags["opening_hours"] = schedule.opening_hours
+    try:
+        shapes_ids = tuple(set([gtfs.trips[trip_id].shape_id for trip_id in gtfs.trips_by_list_of_stops[list_of_stops]]))
+    except:
+        shapes_ids = ()
+    return RouteRecord(
+        list_of_stops=list_of_stops,
+        ref=ref,
+        route_tag=route_type_route_tag[route_type],
+        route_master_name=route_name.split(":")[0] + ": " + official_name,
+        agency=gtfs.get_agency(list_of_stops),
+        tags=tags,
+        shapes_ids=shapes_ids)
+
+# MyGTFS lu par les processus de compute_route_records: ils le
+# partagent par fork, sans qu'il soit sérialisé.
+_route_records_gtfs = None
+_route_records_days_masks = None
+
+def compute_route_record_job(list_of_stops):
+    return compute_route_record(_route_records_gtfs, list_of_stops, _route_records_days_masks)
+
+def compute_route_records(gtfs, lists_of_stops, jobs=1):
+    """Return the RouteRecord of each list of stops, in the same order.
+       With jobs > 1, they are computed in a pool of jobs processes (only
+       where processes can be forked, the pool workers sharing gtfs).
+    """
+    global _route_records_gtfs, _route_records_days_masks
+    _route_records_days_masks = {}
+    if jobs > 1 and len(lists_of_stops) > 1 and "fork" in multiprocessing.get_all_start_methods():
+        _route_records_gtfs = gtfs
+        try:
+            with multiprocessing.get_context("fork").Pool(jobs) as pool:
+                chunksize = max(1, len(lists_of_stops) // (jobs * 4))
+                return pool.map(compute_route_record_job, lists_of_stops, chunksize)
+        finally:
+            _route_records_gtfs = None
+    return [
+        compute_route_record(gtfs, list_of_stops, _route_records_days_masks)
+        for list_of_stops in lists_of_stops]
+
+def route_relation(record, stop_osm_id, way_ids_by_shape_id):
+    """Return the (members, tags) of the route relation of a RouteRecord,
+       given the OSM ids of the stops and of the ways of each shape."""
+    tags = dict(record.tags)
+    members = []
+    missing_stops = []
+    for stop_id in record.list_of_stops:
+        if stop_id in stop_osm_id:
+            members.append(("node", stop_osm_id[stop_id], "platform"))
+        else:
+            missing_stops.append(stop_id)
+            print("ERROR: stop_id " + stop_id + " referenced but not found in GTFS stops.txt")
+    for shape_id in record.shapes_ids:
+        for way_id in way_ids_by_shape_id.get(shape_id, ()):
+            members.append(("way", way_id, ""))
+    if missing_stops:
+        tags["fixme"] = "missing stops " + " ".join(missing_stops)
+    return members, tags
+
+def write_osm_pseudo_ways(gtfs, agency, osm_filename, agency_id=None, jobs=1, simplify=0, snap=0):
+    """Write the stops, shapes and routes of gtfs in osm_filename.
+       With agency_id, only the routes of this agency are written, with the
+       stops and shapes they use. The routes are computed by jobs processes.
+       simplify and snap are the tolerances in meters of shapes_geometry.
+       Return the count of written items by type.
+    """
     print("write " + osm_filename)
-    f = open(osm_filename, "w")
-
-    f.write("<?xml version='1.0' encoding='UTF-8'?>\n")
-    f.write("<osm version='0.6' upload='never' generator='%s'>\n" % (sys.argv[0],))
-
-
-    id_count = -1
-    stop_osm_id = {}
-
-    for stop in gtfs.stops.values():
-        id_count = id_count - 1
-        stop_osm_id[stop.stop_id] = id_count
-        f.write("  <node id='{stop_id}' action='modify' visible='true' lat='{stop_lat}' lon='{stop_lon}'>\n".format(
-            stop_id=id_count,
-            stop_lat=stop.stop_lat,
-            stop_lon=stop.stop_lon))
-        f.write('    <tag k="highway" v="bus_stop" />\n')
-        f.write('    <tag k="public_transport" v="platform" />\n')
-        f.write('    <tag k="bus" v="yes" />\n')
-        f.write('    <tag k="source" v="{0}" />\n'.format(SOURCE_ATTRIBUTE_OF_AGENCY.get(agency.agency_name,"")))
-        f.write('    <tag k="source:date" v="{0}" />\n'.format(MIN_DATE))
-        f.write('    <tag k="name" v="{0}" />\n'.format(stop.stop_name.replace('"','')))
-        f.write('    <tag k="stop_id" v="{0}" />\n'.format(stop.stop_id))
-        f.write('    <tag k="ref" v="{0}" />\n'.format(stop.stop_code))
-        f.write('    <tag k="{0}" v="{1}" />\n'.format(REF_ATTRIBUTE_OF_AGENCY.get(agency.agency_name, "ref"), stop.stop_code))
-        f.write("  </node>\n")
-        #stop_pos_lon=str(stop.stop_lon)
-        #stop_pos_lat=str(float(stop.stop_lat)+ 0.00001)
-        #id_count = id_count - 1
-        #f.write("  <node id='{stop_id}' action='modify' visible='true' lat='{stop_pos_lat}' lon='{stop_pos_lon}'>\n".format(
-        #    stop_id=id_count,
-        #    stop_pos_lat=stop_pos_lat,
-        #    stop_pos_lon=stop_pos_lon))
-        #f.write('    <tag k="name" v="{0}" />\n'.format(stop.stop_name.replace('"','')))
-        #f.write('    <tag k="public_transport" v="stop_position" />\n')
-        #f.write('    <tag k="bus" v="yes" />\n')
-        #f.write('    <tag k="source" v="extrapolation" />\n')
-        #f.write("  </node>\n")
-
-
-    osm_node_by_lon_lat = {}
-    way_ids_by_shape_id = defaultdict(list)
-    shape_ids_by_node_couple = defaultdict(set)
-    way_id_by_node_couple = {}
-    for shape_id, shape in gtfs.shapes.items():
-        last_point = None
-        for point in shape:
-            lon_lat = (float(point.shape_pt_lon), float(point.shape_pt_lat))
-            if lon_lat in osm_node_by_lon_lat:
-                node_id = osm_node_by_lon_lat[lon_lat]
-            else:
-                id_count = id_count - 1
-                osm_node_by_lon_lat[lon_lat] = id_count
-                f.write("  <node id='{node_id}' action='modify' visible='true' lat='{lat}' lon='{lon}' />\n".format(
-                    node_id=id_count,
-                    lat=point.shape_pt_lat,
-                    lon=point.shape_pt_lon))
-                node_id = id_count
-            if last_point:
-                last_lon_lat = (float(last_point.shape_pt_lon), float(last_point.shape_pt_lat))
-                last_node_id = osm_node_by_lon_lat[last_lon_lat]
-                shape_ids_by_node_couple[(last_node_id, node_id)].add(shape_id)
-                shape_ids_by_node_couple[(node_id, last_node_id)].add(shape_id)
-            last_point = point
-    for shape_id, shape in gtfs.shapes.items():
-        route_type = gtfs.get_shape_route_type(shape_id)
-        last_point = None
-        last_shape_ids = None
-        way_open = False
-        way_ids = way_ids_by_shape_id[shape_id]
-        for point in shape:
-            lon_lat = (float(point.shape_pt_lon), float(point.shape_pt_lat))
-            node_id = osm_node_by_lon_lat[lon_lat]
-            if last_point:
-                last_lon_lat = (float(last_point.shape_pt_lon), float(last_point.shape_pt_lat))
-                last_node_id = osm_node_by_lon_lat[last_lon_lat]
-                if (last_node_id, node_id) in way_id_by_node_couple:
-                    way_id = way_id_by_node_couple[(last_node_id, node_id)]
+    if agency_id is None:
+        all_lists_of_stops = gtfs.all_lists_of_stops
+        stops = list(gtfs.stops.values())
+        shapes = gtfs.shapes
+    else:
+        all_lists_of_stops = [
+            list_of_stops for list_of_stops in gtfs.all_lists_of_stops
+            if agency_id in gtfs.agencies_ids_by_list_of_stops[list_of_stops]]
+        stops_ids = set(itertools.chain.from_iterable(all_lists_of_stops))
+        stops = [stop for stop in gtfs.stops.values() if stop.stop_id in stops_ids]
+        shapes_ids = set([
+            getattr(gtfs.trips[trip_id], "shape_id", "")
+            for list_of_stops in all_lists_of_stops
+            for trip_id in gtfs.trips_by_list_of_stops[list_of_stops]])
+        shapes = {shape_id: shape for shape_id, shape in gtfs.shapes.items() if shape_id in shapes_ids}
+    counts = defaultdict(int)
+    with OsmStreamWriter(osm_filename, {"version": "0.6", "upload": "never", "generator": sys.argv[0]}) as writer:
+        id_count = -1
+        stop_osm_id = {}
+
+        for stop in stops:
+            id_count = id_count - 1
+            stop_osm_id[stop.stop_id] = id_count
+            writer.node(id_count, stop.stop_lon, stop.stop_lat, stop_tags(stop, agency),
+                        action="modify", visible="true")
+        counts["stops"] = len(stops)
+
+        # Les points des shapes sont dédupliqués sur leurs coordonnées
+        # arrondies à 1e-7 degré, codées dans un seul entier.
+        osm_node_by_lon_lat = {}
+        node_ids_by_shape_id = {}
+        # les points consécutifs identiques ne sont fusionnés que si la
+        # géométrie est modifiée, pour garder la sortie par défaut inchangée
+        merge_duplicates = simplify > 0 or snap > 0
+        for shape_id, points in shapes_geometry(shapes, simplify, snap):
+            node_ids = array("q")
+            for lon, lat in points:
+                lon_lat = lon * COORDINATE_KEY_FACTOR + lat
+                node_id = osm_node_by_lon_lat.get(lon_lat)
+                if node_id is None:
+                    id_count = id_count - 1
+                    node_id = id_count
+                    osm_node_by_lon_lat[lon_lat] = node_id
+                    writer.node(node_id, format_coordinate(lon), format_coordinate(lat),
+                                action="modify", visible="true")
+                if not (merge_duplicates and node_ids and node_ids[-1] == node_id):
+                    node_ids.append(node_id)
+            node_ids_by_shape_id[shape_id] = node_ids
+        counts["nodes"] = len(osm_node_by_lon_lat)
+        del osm_node_by_lon_lat
+
+        # Ensemble des shapes passant par chaque segment; les ensembles
+        # identiques sont partagés entre les segments.
+        shape_ids_by_node_couple = {}
+        shape_ids_sets = {}
+        for shape_id, node_ids in node_ids_by_shape_id.items():
+            for last_node_id, node_id in zip(node_ids, node_ids[1:]):
+                key = node_couple_key(last_node_id, node_id)
+                shape_ids = shape_ids_by_node_couple.get(key, frozenset()) | frozenset([shape_id])
+                shape_ids_by_node_couple[key] = shape_ids_sets.setdefault(shape_ids, shape_ids)
+        del shape_ids_sets
+
+        way_ids_by_shape_id = defaultdict(list)
+        way_id_by_node_couple = {}
+        for shape_id, node_ids in node_ids_by_shape_id.items():
+            route_type = gtfs.get_shape_route_type(shape_id)
+            way_tags = dict([route_type_way_tag[route_type]])
+            way_ids = way_ids_by_shape_id[shape_id]
+            way_id = None
+            way_nodes = None
+            last_shape_ids = None
+            for last_node_id, node_id in zip(node_ids, node_ids[1:]):
+                key = node_couple_key(last_node_id, node_id)
+                if key in way_id_by_node_couple:
+                    segment_way_id = way_id_by_node_couple[key]
+                    # le segment suivant ne peut pas prolonger la way ouverte
+                    last_shape_ids = None
                 else:
-                    shape_ids = shape_ids_by_node_couple[(last_node_id, node_id)]
+                    shape_ids = shape_ids_by_node_couple[key]
                     if shape_ids == last_shape_ids:
                         # keep the same way_id as previous one
-                        f.write("    <nd ref='{0}' />\n".format(node_id))
+                        way_nodes.append(node_id)
                     else:
                         last_shape_ids = shape_ids
-                        if way_open:
-                            f.write("  </way>\n")
-                        else:
-                            way_open = True
+                        if way_nodes:
+                            writer.way(way_id, way_nodes, way_tags, action="modify", visible="true")
+                            counts["ways"] += 1
                         id_count = id_count - 1
                         way_id = id_count
-                        f.write("  <way id='{0}' action='modify' visible='true'>\n".format(way_id))
-                        f.write('    <tag k="{0}" v="{1}" />\n'.format(*route_type_way_tag[route_type]))
-                        f.write("    <nd ref='{0}' />\n".format(last_node_id))
-                        f.write("    <nd ref='{0}' />\n".format(node_id))
-                    way_id_by_node_couple[(last_node_id, node_id)] = way_id
-                    way_id_by_node_couple[(node_id, last_node_id)] = way_id
-
-                if (len(way_ids) == 0) or (way_ids[-1] != way_id):
-                    way_ids.append(way_id)
-            last_point = point
-        if way_open:
-            f.write("  </way>\n")
-
-    route_master_routes = defaultdict(list)
-    route_master_name = {}
-    route_master_tag = {}
-    route_master_agency = {}
-    for list_of_stops in gtfs.all_lists_of_stops:
-        id_count = id_count - 1
-        ref = gtfs.get_ref_from_list_of_stops(list_of_stops)
-        route_type = gtfs.get_route_type(list_of_stops)
-        route_name = gtfs.get_osm_name_from_list_of_stops(list_of_stops)
-        route_tag = route_type_route_tag[route_type]
-        official_name = gtfs.get_name_from_list_of_stops(list_of_stops)
-        route_master_name[ref] = route_name.split(":")[0] + ": " + official_name
-        route_master_tag[ref] = route_tag
-        route_master_agency[ref] = gtfs.get_agency(list_of_stops)
-        route_master_routes[ref].append(id_count)
-        interval, interval_conditional = gtfs.get_interval_from_list_of_stops(list_of_stops)
-        f.write("  <relation id='{0}' action='modify' visible='true'>\n".format(id_count))
-        f.write('    <tag k="name" v="{0}" />\n'.format(route_name))
-        f.write('    <tag k="official_name" v="{0}" />\n'.format(official_name))
-        f.write('    <tag k="description" v="{0}" />\n'.format(gtfs.get_headsign_from_list_of_stops(list_of_stops)))
-        f.write('    <tag k="ref" v="{0}" />\n'.format(ref))
-        f.write('    <tag k="type" v="route" />\n')
-        f.write('    <tag k="route" v="{0}" />\n'.format(route_tag))
-        f.write('    <tag k="oneway" v="yes" />\n')
-        f.write('    <tag k="duration" v="{0}" />\n'.format(gtfs.get_duration_from_list_of_stops(list_of_stops)))
-        f.write('    <tag k="start_date" v="{0}" />\n'.format(format_date(gtfs.get_start_date_from_list_of_stops(list_of_stops))))
-        f.write('    <tag k="end_date" v="{0}" />\n'.format(format_date(gtfs.get_end_date_from_list_of_stops(list_of_stops))))
-        f.write('    <tag k="operator" v="{0}" />\n'.format(gtfs.get_agency(list_of_stops)))
-        f.write('    <tag k="public_transport:version" v="2" />\n')
-        missing_stops = []
-        if interval:
-            f.write('    <tag k="interval" v="{0}" />\n'.format(interval))
-        if interval_conditional:
-            f.write('    <tag k="interval" v="{0}" />\n'.format(interval_conditional))
-        f.write('    <tag k="opening_hours" v="{0}" />\n'.format(gtfs.get_opening_hours_from_list_of_stops(list_of_stops)))
-        for stop_id in list_of_stops:
-            if stop_id in stop_osm_id:
-                f.write("    <member type='node' role='platform' ref='{0}' />\n".format(stop_osm_id[stop_id]))
-            else:
-                missing_stops.append(stop_id)
-                print("ERROR: stop_id " + stop_id + " referenced but not found in GTFS stops.txt")
-        try:
-            for shape_id in set([gtfs.trips[trip_id].shape_id for trip_id in gtfs.trips_by_list_of_stops[list_of_stops]]):
-                for way_id in way_ids_by_shape_id[shape_id]:
-                    f.write("    <member type='way' role='' ref='{0}' />\n".format(way_id))
-        except:
-            pass
-        if missing_stops:
-            f.write('    <tag k="fixme" v="{0}" />\n'.format("missing stops " + " ".join(missing_stops)))
-        f.write("  </relation>\n")
+                        way_nodes = [last_node_id, node_id]
+                    segment_way_id = way_id
+                    way_id_by_node_couple[key] = way_id
+                if (len(way_ids) == 0) or (way_ids[-1] != segment_way_id):
+                    way_ids.append(segment_way_id)
+            if way_nodes:
+                writer.way(way_id, way_nodes, way_tags, action="modify", visible="true")
+                counts["ways"] += 1
+        del way_id_by_node_couple
+        del shape_ids_by_node_couple
 
-    for ref, name in route_master_name.items():
-        id_count = id_count - 1
-        f.write("  <relation id='{0}' action='modify' visible='true'>\n".format(id_count))
-        f.write('    <tag k="type" v="route_master" />\n')
-        f.write('    <tag k="route_master" v="{0}" />\n'.format(route_master_tag[ref]))
-        f.write('    <tag k="name" v="{0}" />\n'.format(name))
-        f.write('    <tag k="ref" v="{0}" />\n'.format(ref))
-        f.write('    <tag k="operator" v="{0}" />\n'.format(route_master_agency[ref]))
-        for route_id in route_master_routes[ref]:
-            f.write("    <member type='relation' role='' ref='{0}' />\n".format(route_id))
-        f.write("  </relation>\n")
+        route_master_routes = defaultdict(list)
+        route_master_name = {}
+        route_master_tag = {}
+        route_master_agency = {}
+        # les ids sont donnés dans l'ordre des listes d'arrêts, comme
+        # pour un calcul en série
+        for record in compute_route_records(gtfs, all_lists_of_stops, jobs):
+            id_count = id_count - 1
+            ref = record.ref
+            route_master_name[ref] = record.route_master_name
+            route_master_tag[ref] = record.route_tag
+            route_master_agency[ref] = record.agency
+            route_master_routes[ref].append(id_count)
+            members, tags = route_relation(record, stop_osm_id, way_ids_by_shape_id)
+            writer.relation(id_count, members, tags, action="modify", visible="true")
+            counts["routes"] += 1
 
+        for ref, name in route_master_name.items():
+            id_count = id_count - 1
+            writer.relation(id_count,
+                [("relation", route_id, "") for route_id in route_master_routes[ref]],
+                {
+                    "type": "route_master",
+                    "route_master": route_master_tag[ref],
+                    "name": name,
+                    "ref": ref,
+                    "operator": route_master_agency[ref],
+                }, action="modify", visible="true")
+            counts["route_masters"] += 1
+    return counts
 
+# Tags qui changent à chaque publication du GTFS, sans intérêt pour la
+# revue des différences entre deux versions.
+DIFF_IGNORED_TAGS = ("start_date", "end_date", "source:date")
 
+GtfsDiff = namedtuple("GtfsDiff", ["created_stops", "modified_stops", "deleted_stops", "created_routes", "modified_routes", "deleted_routes"])
 
-    f.write("</osm>\n")
-    f.close()
+def fingerprint(value):
+    return hashlib.sha1(repr(value).encode("utf-8")).hexdigest()
 
+def stop_fingerprint(stop, agency):
+    tags = stop_tags(stop, agency)
+    return fingerprint((stop.stop_lon, stop.stop_lat, sorted([
+        (key, value) for key, value in tags.items() if key not in DIFF_IGNORED_TAGS])))
 
-def parse_csv(f, typename):
-    rows = iter(csv.reader(f))
-    fields_names = list(map(filter_printable, next(rows)))
+def route_fingerprint(gtfs, record):
+    """Fingerprint of a list of stops: its route tags, its number of trips
+       and the names and positions of its stops."""
+    stops = [
+        (gtfs.stops[stop_id].stop_name, gtfs.stops[stop_id].stop_lon, gtfs.stops[stop_id].stop_lat)
+        if stop_id in gtfs.stops else None
+        for stop_id in record.list_of_stops]
+    tags = sorted([(key, value) for key, value in record.tags.items() if key not in DIFF_IGNORED_TAGS])
+    return fingerprint((record.list_of_stops, len(gtfs.trips_by_list_of_stops[record.list_of_stops]), tags, stops))
+
+def diff_gtfs(old_gtfs, new_gtfs, old_agency, new_agency, jobs=1):
+    """Return the GtfsDiff of the stops (by stop_id) and of the route
+       records (by list of stops) between two versions of a GTFS."""
+    old_stops_fingerprints = {
+        stop_id: stop_fingerprint(stop, old_agency) for stop_id, stop in old_gtfs.stops.items()}
+    created_stops = []
+    modified_stops = []
+    for stop_id, stop in new_gtfs.stops.items():
+        if stop_id not in old_stops_fingerprints:
+            created_stops.append(stop)
+        elif old_stops_fingerprints[stop_id] != stop_fingerprint(stop, new_agency):
+            modified_stops.append(stop)
+    deleted_stops = [stop for stop_id, stop in old_gtfs.stops.items() if stop_id not in new_gtfs.stops]
+
+    old_routes_fingerprints = {
+        record.list_of_stops: route_fingerprint(old_gtfs, record)
+        for record in compute_route_records(old_gtfs, old_gtfs.all_lists_of_stops, jobs)}
+    created_routes = []
+    modified_routes = []
+    for record in compute_route_records(new_gtfs, new_gtfs.all_lists_of_stops, jobs):
+        if record.list_of_stops not in old_routes_fingerprints:
+            created_routes.append(record)
+        elif old_routes_fingerprints[record.list_of_stops] != route_fingerprint(new_gtfs, record):
+            modified_routes.append(record)
+    deleted_lists_of_stops = [
+        list_of_stops for list_of_stops in old_gtfs.all_lists_of_stops
+        if list_of_stops not in new_gtfs.trips_by_list_of_stops]
+    deleted_routes = compute_route_records(old_gtfs, deleted_lists_of_stops, jobs)
+    return GtfsDiff(created_stops, modified_stops, deleted_stops, created_routes, modified_routes, deleted_routes)
+
+DIFF_FIXMES = {
+    "modify_stop": "TODO: arrêt modifié dans les données de référence, à reporter sur l'arrêt existant",
+    "create_stop": "TODO: nouvel arrêt, créé par le fichier osmChange",
+    "delete": "TODO: supprimé des données de référence, à supprimer si présent dans OSM",
+    "create_route": "TODO: route créée dans les données de référence, à ajouter",
+    "modify_route": "TODO: route modifiée dans les données de référence, à reporter sur la route existante",
+}
+
+def diff_stop_osm_ids(new_gtfs):
+    """OSM ids of the stops of the new GTFS, the same in the osmChange and
+       in the review files."""
+    return {stop_id: -2 - i for i, stop_id in enumerate(new_gtfs.stops)}
+
+def add_fixme(tags, fixme):
+    if tags.get("fixme"):
+        fixme = fixme + ";" + tags["fixme"]
+    tags["fixme"] = fixme
+    return tags
+
+def write_osm_change(new_gtfs, diff, new_agency, osm_filename):
+    """Write the created stops of a GtfsDiff in an osmChange file, that can
+       be applied as is. The other changes need the OSM ids and versions of
+       the existing objects, that the GTFS does not know: they are written
+       by write_osm_review. Return the count of written items by type.
+    """
+    print("write " + osm_filename)
+    stop_osm_id = diff_stop_osm_ids(new_gtfs)
+    with OsmStreamWriter(osm_filename, {"version": "0.6", "generator": sys.argv[0]}, root="osmChange") as writer:
+        if diff.created_stops:
+            writer.section("create")
+            for stop in diff.created_stops:
+                writer.node(stop_osm_id[stop.stop_id], stop.stop_lon, stop.stop_lat, stop_tags(stop, new_agency))
+    return {"create_stops": len(diff.created_stops)}
+
+def write_osm_review(new_gtfs, diff, old_agency, new_agency, osm_filename):
+    """Write the changes of a GtfsDiff that can not be applied without the
+       existing OSM objects in a plain .osm file, not to upload: the modified
+       stops, the created and modified route relations with their platform
+       members (and the stops they refer to, with the ids of the osmChange
+       file for the created ones), and the deleted stops and route relations.
+       Each item has a fixme telling what to do in OSM.
+       Return the count of written items by type.
+    """
+    print("write " + osm_filename)
+    stop_osm_id = diff_stop_osm_ids(new_gtfs)
+    modified_stops_ids = set([stop.stop_id for stop in diff.modified_stops])
+    created_stops_ids = set([stop.stop_id for stop in diff.created_stops])
+    routes = [("create_route", record) for record in diff.created_routes] \
+        + [("modify_route", record) for record in diff.modified_routes]
+    referenced_stops_ids = set(itertools.chain.from_iterable(
+        [record.list_of_stops for change, record in routes]))
+    counts = defaultdict(int)
+    with OsmStreamWriter(osm_filename, {"version": "0.6", "upload": "never", "generator": sys.argv[0]}) as writer:
+        for stop_id, stop in new_gtfs.stops.items():
+            tags = stop_tags(stop, new_agency)
+            if stop_id in modified_stops_ids:
+                add_fixme(tags, DIFF_FIXMES["modify_stop"])
+                counts["modify_stops"] += 1
+            elif stop_id in created_stops_ids and stop_id in referenced_stops_ids:
+                add_fixme(tags, DIFF_FIXMES["create_stop"])
+            elif stop_id not in referenced_stops_ids:
+                continue
+            writer.node(stop_osm_id[stop_id], stop.stop_lon, stop.stop_lat, tags)
+        id_count = -2 - len(new_gtfs.stops)
+        for stop in diff.deleted_stops:
+            id_count = id_count - 1
+            writer.node(id_count, stop.stop_lon, stop.stop_lat,
+                        add_fixme(stop_tags(stop, old_agency), DIFF_FIXMES["delete"]))
+        for change, record in routes:
+            id_count = id_count - 1
+            members, tags = route_relation(record, stop_osm_id, {})
+            writer.relation(id_count, members, add_fixme(tags, DIFF_FIXMES[change]))
+            counts[change + "s"] += 1
+        for record in diff.deleted_routes:
+            # les membres de l'ancienne version ne sont pas dans le nouveau GTFS
+            id_count = id_count - 1
+            writer.relation(id_count, [], add_fixme(dict(record.tags), DIFF_FIXMES["delete"]))
+    counts["delete_stops"] = len(diff.deleted_stops)
+    counts["delete_routes"] = len(diff.deleted_routes)
+    return counts
+
+def print_diff_summary(diff):
+    for section, stops, routes in (
+            ("created", diff.created_stops, diff.created_routes),
+            ("modified", diff.modified_stops, diff.modified_routes),
+            ("deleted", diff.deleted_stops, diff.deleted_routes)):
+        print("{}: {} stops, {} routes".format(section, len(stops), len(routes)))
+    refs = sorted(set([
+        record.ref
+        for records in (diff.created_routes, diff.modified_routes, diff.deleted_routes)
+        for record in records]))
+    if refs:
+        print("changed lines: " + " ".join(refs))
+
+
+# Facteur pour coder des coordonnées arrondies à 1e-7 degré
+# (longitude, latitude) dans un seul entier.
+COORDINATE_KEY_FACTOR = 1 << 32
+
+def quantize_coordinate(degrees):
+    return int(round(degrees * 1e7))
+
+def format_coordinate(quantized):
+    sign = "-" if quantized < 0 else ""
+    return "{}{}.{:07d}".format(sign, abs(quantized) // 10000000, abs(quantized) % 10000000)
+
+def node_couple_key(node_id_a, node_id_b):
+    """Key of the segment between two (negative) node ids, whatever its direction."""
+    a, b = sorted((-node_id_a, -node_id_b))
+    return (a << 32) | b
+
+
+METERS_PER_DEGREE = EARTH_RADIUS * math.pi / 180
+
+def shapes_geometry(shapes, simplify=0, snap=0):
+    """Yield (shape_id, list of quantized (lon, lat)) for each shape.
+       With simplify, the points closer than simplify meters to the
+       simplified line are removed (Douglas-Peucker). With snap, the points
+       closer than snap meters to a point already yielded (from any shape)
+       take its coordinates, so that they share its OSM node.
+    """
+    snapper = PointSnapper(snap) if snap > 0 else None
+    for shape_id, shape in shapes.items():
+        points = [(quantize_coordinate(lon), quantize_coordinate(lat)) for lon, lat in shape]
+        if simplify > 0:
+            points = [points[i] for i in douglas_peucker(points, simplify)]
+        if snapper:
+            points = [snapper.snap(lon, lat) for lon, lat in points]
+        yield shape_id, points
+
+def douglas_peucker(points, tolerance):
+    """Return the sorted indexes of the points kept by a Douglas-Peucker
+       simplification of the quantized (lon, lat) points, with a tolerance
+       in meters. The first and last points are always kept.
+    """
+    count = len(points)
+    if count < 3:
+        return list(range(count))
+    # projection équirectangulaire autour du premier point, en mètres
+    lon_factor = METERS_PER_DEGREE * 1e-7 * math.cos(points[0][1] * 1e-7 * math.pi / 180)
+    lat_factor = METERS_PER_DEGREE * 1e-7
+    xs = [lon * lon_factor for lon, lat in points]
+    ys = [lat * lat_factor for lon, lat in points]
+    keep = bytearray(count)
+    keep[0] = keep[-1] = 1
+    tolerance2 = tolerance * tolerance
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        ax = xs[first]
+        ay = ys[first]
+        dx = xs[last] - ax
+        dy = ys[last] - ay
+        length2 = dx * dx + dy * dy
+        farthest = None
+        farthest_distance2 = tolerance2
+        for i in range(first + 1, last):
+            px = xs[i] - ax
+            py = ys[i] - ay
+            if length2 > 0:
+                # distance au segment, et non à la droite, pour les boucles
+                t = min(max((px * dx + py * dy) / length2, 0.0), 1.0)
+                px -= t * dx
+                py -= t * dy
+            distance2 = px * px + py * py
+            if distance2 > farthest_distance2:
+                farthest = i
+                farthest_distance2 = distance2
+        if farthest is not None:
+            keep[farthest] = 1
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [i for i in range(count) if keep[i]]
+
+class PointSnapper(object):
+    """Replace a quantized (lon, lat) point by the first point given before
+       it that is closer than distance meters, found with a grid of cells
+       of distance meters.
+    """
+    def __init__(self, distance):
+        self.distance = distance
+        self.points_by_cell = defaultdict(list)
+    def project(self, lon, lat):
+        y = lat * 1e-7 * METERS_PER_DEGREE
+        x = lon * 1e-7 * METERS_PER_DEGREE * math.cos(lat * 1e-7 * math.pi / 180)
+        return x, y
+    def snap(self, lon, lat):
+        x, y = self.project(lon, lat)
+        cell_x = int(math.floor(x / self.distance))
+        cell_y = int(math.floor(y / self.distance))
+        nearest = None
+        nearest_distance2 = self.distance * self.distance
+        for cx in (cell_x - 1, cell_x, cell_x + 1):
+            for cy in (cell_y - 1, cell_y, cell_y + 1):
+                for point_x, point_y, point in self.points_by_cell.get((cx, cy), ()):
+                    distance2 = (point_x - x) ** 2 + (point_y - y) ** 2
+                    if distance2 < nearest_distance2:
+                        nearest = point
+                        nearest_distance2 = distance2
+        if nearest is None:
+            nearest = (lon, lat)
+            self.points_by_cell[(cell_x, cell_y)].append((x, y, nearest))
+        return nearest
+
+
+def load_gtfs(path=".", use_cache=True):
+    """Return MyGTFS(path), restored from a snapshot stored next to the feed
+       if the feed did not change since it was written."""
+    if not use_cache:
+        return MyGTFS(path)
+    state = load_cached(
+        lambda: MyGTFS(path).__getstate__(),
+        gtfs_cache_filename(path),
+        gtfs_cache_key(path))
+    gtfs = MyGTFS.__new__(MyGTFS)
+    gtfs.__setstate__(state)
+    return gtfs
+
+def gtfs_cache_filename(path):
+    if os.path.isfile(path):
+        return path + ".cache"
+    else:
+        return os.path.join(path, "gtfs.cache")
+
+def gtfs_cache_key(path):
+    if os.path.isfile(path):
+        filenames = [path]
+    else:
+        filenames = sorted([
+            os.path.join(path, filename) for filename in os.listdir(path)
+            if filename.endswith(".txt")])
+    return "\n".join([GTFS_CACHE_VERSION] + [
+        "{} {} {}".format(os.path.basename(filename), os.path.getsize(filename), os.path.getmtime(filename))
+        for filename in filenames])
+
+def dump_namedtuples(table):
+    """Convert a dict of namedtuple to (typename, fields, dict of tuple)."""
+    for row in table.values():
+        return (type(row).__name__, row._fields, {key: tuple(row) for key, row in table.items()})
+    return (None, (), {})
+
+def load_namedtuples(dump):
+    typename, fields_names, rows = dump
+    if typename is None:
+        return {}
     typeclass = namedtuple(typename, fields_names)
-    return [
-        typeclass(*fields)
-        for fields in rows]
+    return {key: typeclass(*row) for key, row in rows.items()}
+
+def parse_csv(f, typename):
+    """Generator of the rows of the CSV file f as typename namedtuples.
+       The file is read one row at a time and closed at the end.
+    """
+    with f:
+        rows = iter(csv.reader(f))
+        fields_names = list(map(filter_printable, next(rows)))
+        typeclass = namedtuple(typename, fields_names)
+        for fields in rows:
+            yield typeclass(*fields)
 
 def filter_printable(s):
     return ''.join(filter(lambda x: x in string.printable, s))
 
+Conversion = namedtuple("Conversion", ["path", "agency_id", "osm_filename", "counts", "seconds", "error"])
+
+def list_agencies_ids_job(job):
+    """Return the agency ids of a feed, or the loading error. The feed
+       snapshot is written on the way, so that the workers of each agency
+       can share it."""
+    path, use_cache = job
+    try:
+        return sorted(load_gtfs(path, use_cache).agency), None
+    except Exception as e:
+        return [], repr(e)
+
+def convert_feed(path, agency_id=None, output_dir=None, use_cache=True, prefix="", jobs=1, simplify=0, snap=0):
+    """Write the .osm file of a feed, or of one agency of a feed,
+       and return its Conversion. The routes are computed by jobs processes.
+    """
+    start = time.time()
+    gtfs = load_gtfs(path, use_cache)
+    if agency_id is None:
+        agencies = list(gtfs.agency.values())
+        osm_filename = "-".join([agency.agency_name for agency in agencies]) + ".osm"
+    else:
+        agencies = [gtfs.agency[agency_id]]
+        osm_filename = agencies[0].agency_name + ".osm"
+    osm_filename = prefix + osm_filename
+    if output_dir:
+        osm_filename = os.path.join(output_dir, osm_filename)
+    counts = write_osm_pseudo_ways(gtfs, agencies[0], osm_filename, agency_id, jobs, simplify, snap)
+    return Conversion(path, agency_id, osm_filename, dict(counts), time.time() - start, None)
+
+def convert_feed_job(job):
+    """convert_feed in a worker process of convert_feeds: an error is
+       returned in the Conversion so that the other feeds are still written."""
+    path, agency_id, output_dir, use_cache, prefix, simplify, snap = job
+    start = time.time()
+    try:
+        return convert_feed(path, agency_id, output_dir, use_cache, prefix, 1, simplify, snap)
+    except Exception as e:
+        return Conversion(path, agency_id, None, {}, time.time() - start, repr(e))
+
+def convert_feeds(paths, jobs=None, split_agencies=False, output_dir=None, use_cache=True, simplify=0, snap=0):
+    """Convert several feeds in a pool of jobs processes (all the cores by
+       default), each one loading its own MyGTFS. With split_agencies, each
+       agency of a feed is written in its own file by its own process.
+       With several feeds, the file names start with the feed name, as
+       different feeds can have the same agency names.
+       Return the list of Conversion, in the order of paths.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    if len(paths) > 1:
+        prefixes = [feed_name(path) + "-" for path in paths]
+    else:
+        prefixes = [""]
+    if not split_agencies:
+        with multiprocessing.Pool(min(jobs, max(len(paths), 1))) as pool:
+            return pool.map(convert_feed_job, [
+                (path, None, output_dir, use_cache, prefix, simplify, snap) for path, prefix in zip(paths, prefixes)],
+                chunksize=1)
+    with multiprocessing.Pool(min(jobs, max(len(paths), 1))) as pool:
+        agencies_ids = pool.map(list_agencies_ids_job, [(path, use_cache) for path in paths], chunksize=1)
+    tasks = [
+        (path, agency_id, output_dir, use_cache, prefix, simplify, snap)
+        for path, prefix, (path_agencies_ids, error) in zip(paths, prefixes, agencies_ids)
+        for agency_id in path_agencies_ids]
+    # un process par agence, et non par feed: un seul feed peut avoir plusieurs agences
+    with multiprocessing.Pool(min(jobs, max(len(tasks), 1))) as pool:
+        conversions = iter(pool.map(convert_feed_job, tasks, chunksize=1))
+    result = []
+    for path, (path_agencies_ids, error) in zip(paths, agencies_ids):
+        if error:
+            result.append(Conversion(path, None, None, {}, 0, error))
+        result.extend(itertools.islice(conversions, len(path_agencies_ids)))
+    return result
+
+def feed_name(path):
+    name = os.path.basename(os.path.normpath(os.path.abspath(path)))
+    if name.endswith(".zip"):
+        name = name[:-len(".zip")]
+    return name
+
+def print_conversions_summary(conversions):
+    types = ["stops", "nodes", "ways", "routes", "route_masters"]
+    print("")
+    print("\t".join(["file"] + types + ["seconds"]))
+    for conversion in conversions:
+        if conversion.error:
+            print("ERROR: {} {}: {}".format(conversion.path, conversion.agency_id or "", conversion.error))
+        else:
+            print("\t".join([conversion.osm_filename]
+                + [str(conversion.counts.get(t, 0)) for t in types]
+                + [str(round(conversion.seconds, 1))]))
+    print("\t".join(["total"]
+        + [str(sum([conversion.counts.get(t, 0) for conversion in conversions])) for t in types]
+        + [""]))
+
+
 if __name__ == '__main__':
-    if len(sys.argv) > 2:
-        print("ERROR: too many arguments")
-    elif len(sys.argv) == 2:
-        path = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Convert GTFS feeds into OSM files to help integrate them in OpenStreetMap")
+    parser.add_argument("paths", nargs="*", default=["."], help="GTFS directories or zip files (default: current directory)")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of parallel processes, converting the feeds (default: number of cores) or, for a single feed and --diff, its routes (default: 1, no process pool)")
+    parser.add_argument("--split-agencies", action="store_true", help="write one file per agency_id of each feed")
+    parser.add_argument("-o", "--output-dir", default=None, help="directory of the written .osm files (default: current directory)")
+    parser.add_argument("--no-cache", action="store_true", help="do not read nor write the parsed GTFS cache")
+    parser.add_argument("--diff", metavar="OLD_PATH", help="write only the changes since the GTFS OLD_PATH: the created stops in an AGENCY.osc osmChange file, the other changes in AGENCY-review.osm")
+    parser.add_argument("--simplify", type=float, default=0, metavar="METERS", help="simplify the shapes with this tolerance (Douglas-Peucker)")
+    parser.add_argument("--snap", type=float, default=0, metavar="METERS", help="merge the shapes points closer than this distance")
+    args = parser.parse_args()
+    use_cache = not args.no_cache
+    if args.diff:
+        if len(args.paths) != 1:
+            parser.error("--diff needs one GTFS path")
+        jobs = args.jobs or 1
+        old_gtfs = load_gtfs(args.diff, use_cache)
+        new_gtfs = load_gtfs(args.paths[0], use_cache)
+        old_agency = list(old_gtfs.agency.values())[0]
+        new_agency = list(new_gtfs.agency.values())[0]
+        diff = diff_gtfs(old_gtfs, new_gtfs, old_agency, new_agency, jobs)
+        name = "-".join([agency.agency_name for agency in new_gtfs.agency.values()])
+        if args.output_dir:
+            name = os.path.join(args.output_dir, name)
+        write_osm_change(new_gtfs, diff, new_agency, name + ".osc")
+        if (diff.modified_stops or diff.created_routes or diff.modified_routes
+                or diff.deleted_stops or diff.deleted_routes):
+            write_osm_review(new_gtfs, diff, old_agency, new_agency, name + "-review.osm")
+        print_diff_summary(diff)
+        sys.exit(0)
+    if len(args.paths) == 1 and not args.split_agencies:
+        # un seul fichier: ses routes ne sont calculées par un pool de
+        # processus forkés qu'avec -j, le pool coûtant de la mémoire
+        jobs = args.jobs or 1
+        conversions = [convert_feed(args.paths[0], None, args.output_dir, use_cache, "", jobs, args.simplify, args.snap)]
     else:
-        path = "."
-    gtfs = MyGTFS(path)
-    osm_filename = "-".join([agency.agency_name for agency in gtfs.agency.values()]) + ".osm"
-    write_osm_pseudo_ways(gtfs, list(gtfs.agency.values())[0], osm_filename)
+        conversions = convert_feeds(args.paths, args.jobs, args.split_agencies, args.output_dir, use_cache, args.simplify, args.snap)
+    if len(conversions) > 1:
+        print_conversions_summary(conversions)
+    if any([conversion.error for conversion in conversions]):
+        sys.exit(-1)
 
@@ -21,10 +21,17 @@ OSM file Parser/Writer
 
 import sys
 import math
+import zlib
+import struct
 import os.path
+import time
+import calendar
 import xml.sax.saxutils
 import xml.parsers.expat
 import itertools
+import concurrent.futures
+from array import array
+from collections import defaultdict, deque
 
 from tools         import iteritems, itervalues, iterkeys
 
@@ -37,6 +44,7 @@ class Osm(object):
         self.ways = {}
         self.relations = {}
         self.bounds = []
+        self.node_indexes = {}
         if not ('version' in self.attrs):
           self.attrs['version'] = '0.6'
         if not ('generator' in self.attrs):
@@ -45,10 +53,19 @@ class Osm(object):
         id = node.id()
         assert(not (id in self.nodes))
         self.nodes[id] = node
+        for index in itervalues(self.node_indexes):
+            index.add(node)
     def create_node(self, attrs,tags=None):
         node = Node(attrs, tags)
         self.add_node(node)
         return node
+    def node_index(self, predicate=None):
+        """Return a NodeIndex of the nodes for which predicate(node) is true
+           (all the nodes if predicate is None). It is built on first call,
+           then kept up to date when nodes are added."""
+        if predicate not in self.node_indexes:
+            self.node_indexes[predicate] = NodeIndex(itervalues(self.nodes), predicate=predicate)
+        return self.node_indexes[predicate]
     def add_way(self, way):
         id = way.id()
         assert(not (id in self.ways))
@@ -145,49 +162,268 @@ class Osm(object):
 
 
 
+class TagSet(dict):
+    """Immutable tags, shared by the items having the same tags (see TagSets).
+       It is a dict for all the reads; Item.own_tags gives an item its own
+       copy of them to change."""
+    __slots__ = ()
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("TagSet is immutable, change item.own_tags()")
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+    __ior__ = _immutable
+    def __reduce__(self):
+        return (TagSet, (dict(self),))
+
+EMPTY_TAGS = TagSet()
+
+class TagSets(object):
+    """Intern table of TagSet: the items having the same tags, in the same
+       order, share one TagSet."""
+    def __init__(self):
+        self.tag_sets = {}
+    def share(self, tags):
+        """Return the TagSet equal to the tags dict."""
+        if not tags:
+            return EMPTY_TAGS
+        key = tuple(iteritems(tags))
+        tag_set = self.tag_sets.get(key)
+        if tag_set is None:
+            tag_set = self.tag_sets[key] = TagSet(tags)
+        return tag_set
+
+def format_degrees(value):
+    """Format a coordinate with the 1e-7 degree precision of OSM, without
+       trailing zeros nor scientific notation (1e-05 is written 0.00001)."""
+    text = ("%.7f" % value).rstrip("0").rstrip(".")
+    if text == "-0":
+        return "0"
+    return text
+
 class Item(object):
+    """Base of Node, Way and Relation.
+       id and version are kept typed; attrs only holds the other
+       attributes (action, visible, user, timestamp...).
+       tags is either the item own dict, or, for the parsed items, a TagSet
+       shared with other items: use own_tags() to change them.
+    """
+    __slots__ = ("_id", "_version", "_attrs", "tags")
     def __init__(self, attrs,tags=None):
-        self.attrs = attrs
-        self.tags = tags or {}
+        attrs = dict(attrs)
+        self.tags = tags if tags is not None else {}
         if 'id' in attrs:
-            id = int(attrs["id"])
+            id = int(attrs.pop("id"))
         else:
             id = Osm.min_id - 1
-            attrs["id"] = str(id)
-        Osm.min_id = min(Osm.min_id, id)
+        if id < Osm.min_id:
+            Osm.min_id = id
+        self._id = id
+        version = attrs.pop("version", None)
+        self._version = int(version) if version is not None else None
+        self._attrs = attrs
+    def own_tags(self):
+        """Return the tags as the item own dict, to change them: a shared
+           TagSet is copied first (copy-on-write)."""
+        if type(self.tags) is TagSet:
+            self.tags = dict(self.tags)
+        return self.tags
     def id(self):
-        return int(self.attrs["id"])
+        return self._id
+    def version(self):
+        return self._version
     def textid(self):
         return self.type()[0] + str(self.id())
+    @property
+    def attrs(self):
+        if self._attrs is None:
+            self._attrs = {}
+        return self._attrs
+    def all_attrs(self):
+        """All the attributes, as strings, in the order to write them."""
+        result = {"id": str(self._id)}
+        if self._version is not None:
+            result["version"] = str(self._version)
+        if self._attrs:
+            result.update(self._attrs)
+        return result
 
 class Node(Item):
+    __slots__ = ("_lon", "_lat")
     def __init__(self, attrs,tags=None):
         Item.__init__(self, attrs, tags)
+        self._lon = float(self._attrs.pop("lon"))
+        self._lat = float(self._attrs.pop("lat"))
+        if not self._attrs:
+            self._attrs = None
     def type(self):
         return "node"
+    def all_attrs(self):
+        result = Item.all_attrs(self)
+        result["lat"] = format_degrees(self._lat)
+        result["lon"] = format_degrees(self._lon)
+        return result
     def lon(self):
-      return float(self.attrs["lon"])
+      return self._lon
     def lat(self):
-      return float(self.attrs["lat"])
+      return self._lat
     def distance(self, node):
-        # http://fr.wikipedia.org/wiki/Distance_du_grand_cercle
-        def square(a): return a*a
-        def degree_to_radian(a): return a * math.pi / 180
-        a_lon = degree_to_radian(float(self.attrs["lon"]))
-        a_lat = degree_to_radian(float(self.attrs["lat"]))
-        b_lon = degree_to_radian(float(node.attrs["lon"]))
-        b_lat = degree_to_radian(float(node.attrs["lat"]))
-        R = 6371000.0 # Earth ray in metter
-        result = 2 * R * math.asin(math.sqrt(
-            square(math.sin((b_lat-a_lat)/2))
-            + math.cos(a_lat)*math.cos(b_lat)*square(math.sin((b_lon-a_lon)/2))
-            ));
+        return distance(self.lon(), self.lat(), node.lon(), node.lat())
+
+EARTH_RADIUS = 6371000.0 # Earth ray in metter
+
+def distance(a_lon, a_lat, b_lon, b_lat):
+    """Great circle distance in metter between two lon/lat points."""
+    # http://fr.wikipedia.org/wiki/Distance_du_grand_cercle
+    def square(a): return a*a
+    def degree_to_radian(a): return a * math.pi / 180
+    a_lon = degree_to_radian(a_lon)
+    a_lat = degree_to_radian(a_lat)
+    b_lon = degree_to_radian(b_lon)
+    b_lat = degree_to_radian(b_lat)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(
+        square(math.sin((b_lat-a_lat)/2))
+        + math.cos(a_lat)*math.cos(b_lat)*square(math.sin((b_lon-a_lon)/2))
+        ))
+
+def radians_points(points):
+    """Return the (lon, lat, cos(lat)) in radians of (lon, lat) points in
+       degrees, to compute many distances from them with distances_from."""
+    cos = math.cos
+    pi = math.pi
+    result = []
+    for lon, lat in points:
+        lat = lat * pi / 180
+        result.append((lon * pi / 180, lat, cos(lat)))
+    return result
+
+def distances_from(lon, lat, radians):
+    """Great circle distances in metter from lon/lat to each point of
+       radians (as returned by radians_points). The values are the same
+       as the ones of distance(lon, lat, ...)."""
+    sin = math.sin
+    asin = math.asin
+    sqrt = math.sqrt
+    a_lon = lon * math.pi / 180
+    a_lat = lat * math.pi / 180
+    a_cos = math.cos(a_lat)
+    diameter = 2 * EARTH_RADIUS
+    result = []
+    for b_lon, b_lat, b_cos in radians:
+        sin_lat = sin((b_lat - a_lat) / 2)
+        sin_lon = sin((b_lon - a_lon) / 2)
+        result.append(diameter * asin(sqrt(sin_lat * sin_lat + a_cos * b_cos * (sin_lon * sin_lon))))
+    return result
+
+def distances(lon, lat, points):
+    """Great circle distances in metter from lon/lat to each (lon, lat) of points."""
+    return distances_from(lon, lat, radians_points(points))
+
+def distances_matrix(sources, targets):
+    """Great circle distances in metter between each (lon, lat) of sources
+       and each (lon, lat) of targets, as a list (by source) of lists (by
+       target). The trigonometry of the targets is computed only once."""
+    radians = radians_points(targets)
+    return [distances_from(lon, lat, radians) for lon, lat in sources]
+
+class NodeIndex(object):
+    """Grid index of nodes on lon/lat, for radius and nearest node queries.
+       Only the nodes for which predicate(node) is true (all if predicate
+       is None) are indexed.
+    """
+    def __init__(self, nodes=(), cell_size=0.005, predicate=None):
+        self.cell_size = cell_size
+        self.predicate = predicate
+        self.cells = defaultdict(list)
+        for node in nodes:
+            self.add(node)
+    def cell(self, lon, lat):
+        return int(math.floor(lon / self.cell_size)), int(math.floor(lat / self.cell_size))
+    def add(self, node):
+        if (self.predicate is None) or self.predicate(node):
+            self.cells[self.cell(node.lon(), node.lat())].append(node)
+    def remove(self, node):
+        cell = self.cells.get(self.cell(node.lon(), node.lat()))
+        if cell and node in cell:
+            cell.remove(node)
+    def __len__(self):
+        return sum([len(cell) for cell in itervalues(self.cells)])
+    def within(self, lon, lat, radius):
+        """Return the (distance, node) list of the nodes at less than
+           radius metters of lon/lat, sorted by distance."""
+        lat_delta = math.degrees(radius / EARTH_RADIUS)
+        lon_delta = lat_delta / max(math.cos(math.radians(lat)), 1e-6)
+        min_x, min_y = self.cell(lon - lon_delta, lat - lat_delta)
+        max_x, max_y = self.cell(lon + lon_delta, lat + lat_delta)
+        result = []
+        for x in range(min_x, max_x + 1):
+            for y in range(min_y, max_y + 1):
+                for node in self.cells.get((x, y), ()):
+                    d = distance(lon, lat, node.lon(), node.lat())
+                    if d <= radius:
+                        result.append((d, node))
+        result.sort(key=lambda distance_node: distance_node[0])
+        return result
+    def nearest(self, lon, lat, max_distance=1000, predicate=None):
+        """Return (distance, node) of the nearest node at less than
+           max_distance metters for which predicate(node) is true,
+           or (None, None)."""
+        for d, node in self.within(lon, lat, max_distance):
+            if (predicate is None) or predicate(node):
+                return d, node
+        return None, None
+    def candidates_many(self, points, max_distance=1000, predicate=None):
+        """Yield, for each (lon, lat) of points, the list of the nodes of the
+           cells at less than max_distance metters for which predicate(node)
+           is true, and the list of their distances to the point. The
+           candidate nodes of the points looking in the same cells are
+           filtered and their trigonometry computed only once."""
+        lat_delta = math.degrees(max_distance / EARTH_RADIUS)
+        candidates_by_cells = {}
+        for lon, lat in points:
+            lon_delta = lat_delta / max(math.cos(math.radians(lat)), 1e-6)
+            min_x, min_y = self.cell(lon - lon_delta, lat - lat_delta)
+            max_x, max_y = self.cell(lon + lon_delta, lat + lat_delta)
+            cells = (min_x, min_y, max_x, max_y)
+            candidates = candidates_by_cells.get(cells)
+            if candidates is None:
+                nodes = [
+                    node
+                    for x in range(min_x, max_x + 1)
+                    for y in range(min_y, max_y + 1)
+                    for node in self.cells.get((x, y), ())
+                    if (predicate is None) or predicate(node)]
+                candidates = (nodes, radians_points([(node.lon(), node.lat()) for node in nodes]))
+                candidates_by_cells[cells] = candidates
+            nodes, radians = candidates
+            yield nodes, distances_from(lon, lat, radians)
+    def nearest_many(self, points, max_distance=1000, predicate=None):
+        """Return, for each (lon, lat) of points, the same (distance, node)
+           as nearest(lon, lat, max_distance, predicate)."""
+        result = []
+        for nodes, node_distances in self.candidates_many(points, max_distance, predicate):
+            best = (None, None)
+            for d, node in zip(node_distances, nodes):
+                if d <= max_distance and ((best[0] is None) or (d < best[0])):
+                    best = (d, node)
+            result.append(best)
+        return result
+    def within_many(self, points, radius, predicate=None):
+        """Return, for each (lon, lat) of points, the (distance, node) list
+           of the nodes at less than radius metters for which predicate(node)
+           is true, sorted by distance."""
+        result = []
+        for nodes, node_distances in self.candidates_many(points, radius, predicate):
+            within = [(d, node) for d, node in zip(node_distances, nodes) if d <= radius]
+            within.sort(key=lambda distance_node: distance_node[0])
+            result.append(within)
         return result
 
 class Way(Item):
+    __slots__ = ("nodes",)
     def __init__(self, attrs,tags=None):
         Item.__init__(self, attrs, tags)
-        self.nodes = []
+        if not self._attrs:
+            self._attrs = None
+        self.nodes = array("q")
     def type(self):
         return "way"
     def add_node(self, node):
@@ -197,38 +433,69 @@ class Way(Item):
             self.nodes.append(int(node))
 
 
+MEMBER_TYPES = ("node", "way", "relation")
+MEMBER_TYPE_CODE = {mtype: code for code, mtype in enumerate(MEMBER_TYPES)}
+
 class Relation(Item):
+    __slots__ = ("_member_types", "_member_refs", "_member_roles")
     def __init__(self, attrs,tags=None):
         Item.__init__(self, attrs, tags)
-        self.members = []
+        if not self._attrs:
+            self._attrs = None
+        self._member_types = array("b")
+        self._member_refs = array("q")
+        self._member_roles = []
     def type(self):
         return "relation"
     def add_member_type_ref_role(self, mtype, mref, mrole):
-        attrs = {'type': mtype, 'ref': str(mref), 'role': mrole}
-        self.add_member_attrs(attrs)
+        self._member_types.append(MEMBER_TYPE_CODE[mtype])
+        self._member_refs.append(int(mref))
+        self._member_roles.append(sys.intern(mrole))
     def add_member(self, member, role=""):
-        attrs = {'type': member.type(), 'ref': str(member.id()), 'role': role}
-        self.add_member_attrs(attrs)
+        self.add_member_type_ref_role(member.type(), member.id(), role)
     def add_member_attrs(self, attrs):
-        self.members.append(attrs)
+        self.add_member_type_ref_role(attrs["type"], attrs["ref"], attrs.get("role", ""))
+    @property
+    def members(self):
+        """Members as a list of {'type', 'ref', 'role'} dicts (a copy)."""
+        return [{'type': mtype, 'ref': str(mref), 'role': mrole}
+                for mtype, mref, mrole in self.itermembers()]
     def itermembers(self):
-        for attrs in self.members:
-            yield attrs.get("type"), int(attrs.get("ref")), attrs.get("role")
+        for code, ref, role in zip(self._member_types, self._member_refs, self._member_roles):
+            yield MEMBER_TYPES[code], ref, role
+
+# Attributs répétés sur de nombreux objets, partagés avec sys.intern
+INTERNED_ATTRS = ("user", "uid")
+
+def intern_attrs(attrs):
+    for key in INTERNED_ATTRS:
+        if key in attrs:
+            attrs[key] = sys.intern(attrs[key])
+    return attrs
 
 class OsmParser(object):
-    def __init__(self, factory=Osm):
+    def __init__(self, factory=Osm, predicate=None):
+        """predicate: if given, called with each node, way and relation once
+           its tags are parsed. The items for which it returns False are not
+           kept, except the relations having a kept node or way member.
+        """
         self.parser = xml.parsers.expat.ParserCreate("utf-8")
         assert(self.parser.SetParamEntityParsing(
             xml.parsers.expat.XML_PARAM_ENTITY_PARSING_NEVER))
         self.parser.buffer_text = True
-        self.parser.CharacterDataHandler = self.handle_char_data
         self.parser.StartElementHandler = self.handle_start_element
         self.parser.EndElementHandler = self.handle_end_element
         self.factory = factory
+        self.predicate = predicate
+        self.tag_sets = TagSets()
+        self.current_tags = None
     def parse(self, filename):
+        if filename.endswith(".pbf"):
+            return PbfParser(self.factory, self.predicate).parse(filename)
         self.filename = filename
         self.osm = None
-        self.parser.ParseFile(open(filename, "rb"))
+        with open(filename, "rb") as f:
+            self.parser.ParseFile(f)
         return self.osm
     def parse_stream(self, stream, name=""):
         self.filename = name
@@ -241,7 +508,23 @@ class OsmParser(object):
         self.parser.Parse(data)
         return self.osm
     def handle_start_element(self,name, attrs):
-        if name == "osm":
+        # Tests dans l'ordre de fréquence des éléments
+        if name == "nd":
+            self.current.nodes.append(int(attrs["ref"]))
+        elif name == "tag":
+            self.current_tags[sys.intern(attrs["k"])] = sys.intern(attrs["v"])
+        elif name == "node":
+            self.current = Node(intern_attrs(attrs), EMPTY_TAGS)
+            self.current_tags = {}
+        elif name == "member":
+            self.current.add_member_attrs(attrs)
+        elif name == "way":
+            self.current = Way(intern_attrs(attrs), EMPTY_TAGS)
+            self.current_tags = {}
+        elif name == "relation":
+            self.current = Relation(intern_attrs(attrs), EMPTY_TAGS)
+            self.current_tags = {}
+        elif name == "osm":
             osm = self.factory(attrs)
             self.osm = osm
             self.current = None
@@ -253,37 +536,41 @@ class OsmParser(object):
             pass
         elif name == "bounds":
             self.osm.add_bounds(attrs)
-        elif name == "node":
-            node = self.osm.create_node(attrs);
-            self.current = node
-        elif name == "way":
-            way = self.osm.create_way(attrs)
-            self.current = way
-        elif name == "nd":
-            ref = int(attrs["ref"])
-            way = self.current
-            way.add_node(ref)
-        elif name == "tag":
-            self.current.tags[attrs["k"]] = attrs["v"];
-        elif name == "relation":
-            relation = self.osm.create_relation(attrs)
-            self.current = relation
-        elif name == "member":
-            relation = self.current
-            relation.add_member_attrs(attrs)
         else:
             raise Exception("ERROR: unknown tag <"+name+"> in file "
                     + self.filename + "\n")
     def handle_end_element(self,name):
-        pass
-    def handle_char_data(self,data):
-        pass
+        if name == "node":
+            self.current.tags = self.tag_sets.share(self.current_tags)
+            if self.keep(self.current):
+                self.osm.add_node(self.current)
+        elif name == "way":
+            self.current.tags = self.tag_sets.share(self.current_tags)
+            if self.keep(self.current):
+                self.osm.add_way(self.current)
+        elif name == "relation":
+            self.current.tags = self.tag_sets.share(self.current_tags)
+            if self.keep(self.current):
+                self.osm.add_relation(self.current)
+    def keep(self, item):
+        if (self.predicate is None) or self.predicate(item):
+            return True
+        if isinstance(item, Relation):
+            osm = self.osm
+            for mtype, mref, mrole in item.itermembers():
+                if ((mtype == "node") and (mref in osm.nodes)) \
+                        or ((mtype == "way") and (mref in osm.ways)):
+                    return True
+        return False
 
 class OsmWriter(object):
     def __init__(self, osm):
         self.osm = osm
     def write_to_file(self, filename):
-        self.output = open(filename, mode="w")
+        if filename.endswith(".pbf"):
+            PbfWriter(self.osm).write_to_file(filename)
+            return
+        self.output = open(filename, mode="w", encoding="utf-8", buffering=OUTPUT_BUFFER_SIZE)
         self.write()
         self.output.close()
     def write_to_stream(self, stream):
@@ -291,40 +578,604 @@ class OsmWriter(object):
         self.write()
     def write(self):
         osm = self.osm
-        output = self.output
-        output.write("<?xml version='1.0' encoding='UTF-8'?>\n");
-        output.write("<osm" + self.attrs_str(osm.attrs) + ">\n");
-        for bounds in osm.bounds:
-            output.write("\t<bounds" + self.attrs_str(bounds) + "/>\n");
+        self.write_header(osm.attrs, osm.bounds)
         for node in itervalues(osm.nodes):
-            if len(node.tags):
-                output.write("\t<node" + self.attrs_str(node.attrs) + ">\n");
-                self.write_tags(node.tags)
-                output.write("\t</node>\n");
-            else:
-                output.write("\t<node" + self.attrs_str(node.attrs) + "/>\n");
+            self.write_node(node.all_attrs(), node.tags)
         for way in itervalues(osm.ways):
-            output.write("\t<way" + self.attrs_str(way.attrs) + ">\n");
-            for ref_node in way.nodes:
-                output.write('\t\t<nd ref="' + str(ref_node) + '"/>\n');
-            self.write_tags(way.tags)
-            output.write("\t</way>\n");
+            self.write_way(way.all_attrs(), way.nodes, way.tags)
         for relation in itervalues(osm.relations):
-            output.write("\t<relation"
-                + self.attrs_str(relation.attrs) + ">\n");
-            self.write_tags(relation.tags)
-            for member in relation.members:
-                output.write('\t\t<member' + self.attrs_str(member) + "/>\n");
-            output.write("\t</relation>\n");
-        output.write("</osm>\n");
+            self.write_relation(relation.all_attrs(), relation.itermembers(), relation.tags)
+        self.write_footer()
+    def write_header(self, attrs, bounds=(), root="osm"):
+        self.output.write("<?xml version='1.0' encoding='UTF-8'?>\n");
+        self.output.write("<" + root + self.attrs_str(attrs) + ">\n");
+        for b in bounds:
+            self.output.write("\t<bounds" + self.attrs_str(b) + "/>\n");
+    def write_footer(self, root="osm"):
+        self.output.write("</" + root + ">\n");
+    def write_node(self, attrs, tags):
+        output = self.output
+        if len(tags):
+            output.write("\t<node" + self.attrs_str(attrs) + ">\n");
+            self.write_tags(tags)
+            output.write("\t</node>\n");
+        else:
+            output.write("\t<node" + self.attrs_str(attrs) + "/>\n");
+    def write_way(self, attrs, nodes, tags):
+        output = self.output
+        output.write("\t<way" + self.attrs_str(attrs) + ">\n");
+        for ref_node in nodes:
+            output.write('\t\t<nd ref="' + str(ref_node) + '"/>\n');
+        self.write_tags(tags)
+        output.write("\t</way>\n");
+    def write_relation(self, attrs, members, tags):
+        """members: iterable of (type, ref, role)"""
+        output = self.output
+        output.write("\t<relation" + self.attrs_str(attrs) + ">\n");
+        self.write_tags(tags)
+        for mtype, mref, mrole in members:
+            output.write('\t\t<member type=' + xml.sax.saxutils.quoteattr(mtype)
+                + ' ref="' + str(mref) + '" role='
+                + xml.sax.saxutils.quoteattr(mrole) + "/>\n");
+        output.write("\t</relation>\n");
     def attrs_str(self, attrs):
-        return ("".join([' ' + key + '=' + xml.sax.saxutils.quoteattr(value)
+        return ("".join([' ' + key + '=' + xml.sax.saxutils.quoteattr(str(value))
             for key,value in iteritems(attrs)]))#.encode("utf-8")
     def write_tags(self, tags):
         for key,value in iteritems(tags):
-            value = xml.sax.saxutils.quoteattr(value)
             self.output.write(
-                ('\t\t<tag k="' + key + '" v=' + value +'/>\n')#.encode("utf-8")
+                ('\t\t<tag k=' + xml.sax.saxutils.quoteattr(key)
+                 + ' v=' + xml.sax.saxutils.quoteattr(value) +'/>\n')#.encode("utf-8")
             )
 
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+class OsmStreamWriter(OsmWriter):
+    """Write an OSM file element by element, without building an Osm object
+       in memory. All the nodes must be written before the ways, and the
+       ways before the relations.
+       With root="osmChange", the elements are written in create, modify
+       or delete blocks started with section().
+    """
+    ELEMENTS_ORDER = ("node", "way", "relation")
+    def __init__(self, filename_or_stream, attrs=None, root="osm"):
+        OsmWriter.__init__(self, None)
+        if hasattr(filename_or_stream, "write"):
+            self.output = filename_or_stream
+            self.close_output = False
+        else:
+            self.output = open(filename_or_stream, mode="w", encoding="utf-8", buffering=OUTPUT_BUFFER_SIZE)
+            self.close_output = True
+        self.root = root
+        self.element_index = 0
+        self.section_name = None
+        attrs = dict(attrs or {})
+        attrs.setdefault("version", "0.6")
+        attrs.setdefault("generator", os.path.basename(sys.argv[0]))
+        self.write_header(attrs, root=root)
+    def check_order(self, element):
+        index = self.ELEMENTS_ORDER.index(element)
+        assert index >= self.element_index, element + " written after " + self.ELEMENTS_ORDER[self.element_index]
+        self.element_index = index
+    def node(self, id, lon, lat, tags=None, **attrs):
+        self.check_order("node")
+        attrs = dict(id=id, **attrs)
+        attrs["lat"] = lat
+        attrs["lon"] = lon
+        self.write_node(attrs, tags or {})
+    def way(self, id, nodes, tags=None, **attrs):
+        self.check_order("way")
+        self.write_way(dict(id=id, **attrs), nodes, tags or {})
+    def relation(self, id, members, tags=None, **attrs):
+        """members: iterable of (type, ref, role)"""
+        self.check_order("relation")
+        self.write_relation(dict(id=id, **attrs), members, tags or {})
+    def section(self, name):
+        """Close the current osmChange block and start a new one named
+           name ("create", "modify" or "delete")."""
+        self.end_section()
+        self.output.write("<" + name + ">\n")
+        self.section_name = name
+        self.element_index = 0
+    def end_section(self):
+        if self.section_name:
+            self.output.write("</" + self.section_name + ">\n")
+            self.section_name = None
+    def close(self):
+        self.end_section()
+        self.write_footer(self.root)
+        if self.close_output:
+            self.output.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, type, value, traceback):
+        self.close()
+        return False
+
+
+# .osm.pbf format: https://wiki.openstreetmap.org/wiki/PBF_Format
+#
+# The protobuf messages are decoded and encoded by hand, with the field
+# numbers of fileformat.proto and osmformat.proto.
+
+PBF_MAX_BLOCK_ITEMS = 8000
+PBF_GRANULARITY = 100 # in nanodegrees, ie 1e-7 degree
+PBF_META_ATTRS = ("timestamp", "changeset", "uid", "user")
+# Threads de décompression, et blobs lus à l'avance par thread
+PBF_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+PBF_BLOBS_PER_WORKER = 2
+
+def pbf_read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+def pbf_iter_fields(data):
+    """Yield (field number, value) of a protobuf message: value is an int
+       for varint fields, and bytes for the other ones."""
+    pos = 0
+    end = len(data)
+    while pos < end:
+        key, pos = pbf_read_varint(data, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = pbf_read_varint(data, pos)
+        elif wire_type == 2:
+            length, pos = pbf_read_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire_type == 1:
+            value = data[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = data[pos:pos + 4]
+            pos += 4
+        else:
+            raise Exception("ERROR: unsupported protobuf wire type " + str(wire_type))
+        yield number, value
+
+def pbf_packed(data):
+    if max(data, default=0) < 0x80:
+        return list(data)
+    values = []
+    append = values.append
+    pos = 0
+    end = len(data)
+    while pos < end:
+        b = data[pos]
+        pos += 1
+        if b < 0x80:
+            append(b)
+            continue
+        value = b & 0x7f
+        shift = 7
+        while True:
+            b = data[pos]
+            pos += 1
+            value |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        append(value)
+    return values
+
+def pbf_int64(value):
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def pbf_unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+def pbf_delta(values):
+    result = []
+    current = 0
+    for value in values:
+        current += pbf_unzigzag(value)
+        result.append(current)
+    return result
+
+def pbf_varint(value):
+    if value < 0:
+        value += 1 << 64
+    result = bytearray()
+    while value >= 0x80:
+        result.append((value & 0x7f) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+def pbf_varint_int32(value):
+    """Two's complement of a negative int32, as protobuf encodes it."""
+    return value + (1 << 64) if value < 0 else value
+
+def pbf_zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+def pbf_field_varint(number, value):
+    return pbf_varint(number << 3) + pbf_varint(value)
+
+def pbf_field_bytes(number, data):
+    return pbf_varint((number << 3) | 2) + pbf_varint(len(data)) + data
+
+def pbf_field_packed(number, values):
+    if not values:
+        return b""
+    return pbf_field_bytes(number, b"".join([pbf_varint(value) for value in values]))
+
+def pbf_deltas(values):
+    result = []
+    previous = 0
+    for value in values:
+        result.append(pbf_zigzag(value - previous))
+        previous = value
+    return result
+
+def pbf_format_timestamp(seconds):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
+
+def pbf_parse_timestamp(timestamp):
+    return calendar.timegm(time.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ"))
 
+
+class PbfParser(OsmParser):
+    """Read a .osm.pbf file into the same Osm object model as OsmParser.
+       The blocks are decompressed in parallel threads.
+    """
+    def parse(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            return self.parse_stream(f, filename)
+    def parse_stream(self, stream, name=""):
+        self.filename = name
+        self.osm = None
+        with concurrent.futures.ThreadPoolExecutor(PBF_WORKERS) as executor:
+            for blob_type, data in self.read_blobs(executor, stream):
+                if blob_type == "OSMHeader":
+                    self.read_header_block(data)
+                elif blob_type == "OSMData":
+                    if self.osm is None:
+                        self.osm = self.factory({})
+                    self.read_primitive_block(data)
+        if self.osm is None:
+            self.osm = self.factory({})
+        return self.osm
+    def read_blobs(self, executor, stream):
+        """Yield the (type, data) of the blobs of stream, in order, decompressed
+           by executor. Only a window of PBF_BLOBS_PER_WORKER blobs per worker
+           is read ahead, so that the memory used does not grow with the file."""
+        window = PBF_BLOBS_PER_WORKER * PBF_WORKERS
+        futures = deque()
+        for blob in self.iter_blobs(stream):
+            futures.append(executor.submit(self.read_blob, blob))
+            if len(futures) >= window:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+    def iter_blobs(self, stream):
+        while True:
+            size = stream.read(4)
+            if len(size) < 4:
+                return
+            blob_header = stream.read(struct.unpack("!I", size)[0])
+            blob_type = None
+            data_size = 0
+            for number, value in pbf_iter_fields(blob_header):
+                if number == 1:
+                    blob_type = bytes(value).decode("utf-8")
+                elif number == 3:
+                    data_size = value
+            yield blob_type, stream.read(data_size)
+    def read_blob(self, blob_type_blob):
+        blob_type, blob = blob_type_blob
+        for number, value in pbf_iter_fields(blob):
+            if number == 1:
+                return blob_type, value
+            elif number == 3:
+                return blob_type, zlib.decompress(value)
+            elif number != 2:
+                raise Exception("ERROR: unsupported blob compression in file " + self.filename)
+        return blob_type, b""
+    def read_header_block(self, data):
+        attrs = {}
+        bounds = None
+        for number, value in pbf_iter_fields(data):
+            if number == 1:
+                bbox = dict([(n, pbf_unzigzag(v) / 1e9) for n, v in pbf_iter_fields(value)])
+                bounds = {
+                    "minlon": repr(bbox.get(1, 0.0)),
+                    "maxlon": repr(bbox.get(2, 0.0)),
+                    "maxlat": repr(bbox.get(3, 0.0)),
+                    "minlat": repr(bbox.get(4, 0.0))}
+            elif number == 4:
+                feature = bytes(value).decode("utf-8")
+                if feature not in ("OsmSchema-V0.6", "DenseNodes"):
+                    raise Exception("ERROR: unsupported feature " + feature + " in file " + self.filename)
+            elif number == 16:
+                attrs["generator"] = bytes(value).decode("utf-8")
+        self.osm = self.factory(attrs)
+        if bounds:
+            self.osm.add_bounds(bounds)
+    def read_primitive_block(self, data):
+        self.strings = []
+        self.granularity = PBF_GRANULARITY
+        self.lat_offset = 0
+        self.lon_offset = 0
+        self.date_granularity = 1000
+        groups = []
+        for number, value in pbf_iter_fields(data):
+            if number == 1:
+                self.strings = [sys.intern(bytes(s).decode("utf-8")) for n, s in pbf_iter_fields(value) if n == 1]
+            elif number == 2:
+                groups.append(value)
+            elif number == 17:
+                self.granularity = value
+            elif number == 18:
+                self.date_granularity = value
+            elif number == 19:
+                self.lat_offset = pbf_int64(value)
+            elif number == 20:
+                self.lon_offset = pbf_int64(value)
+        for group in groups:
+            for number, value in pbf_iter_fields(group):
+                if number == 1:
+                    self.read_node(value)
+                elif number == 2:
+                    self.read_dense_nodes(value)
+                elif number == 3:
+                    self.read_way(value)
+                elif number == 4:
+                    self.read_relation(value)
+    def coordinate(self, offset, value):
+        # a division (and not a multiplication by 1e-9) gives the shortest repr
+        return (offset + self.granularity * value) / 1e9
+    def info_attrs(self, version, timestamp, changeset, uid, user_sid):
+        attrs = {}
+        if version > 0:
+            attrs["version"] = version
+        if timestamp:
+            attrs["timestamp"] = pbf_format_timestamp(timestamp * self.date_granularity // 1000)
+        if changeset:
+            attrs["changeset"] = str(changeset)
+        if uid:
+            attrs["uid"] = sys.intern(str(uid))
+        if user_sid and self.strings[user_sid]:
+            attrs["user"] = self.strings[user_sid]
+        return attrs
+    def read_info(self, data):
+        info = dict([(number, value) for number, value in pbf_iter_fields(data)])
+        return self.info_attrs(
+            pbf_int64(info.get(1, 0)), pbf_int64(info.get(2, 0)), pbf_int64(info.get(3, 0)),
+            pbf_int64(info.get(4, 0)), info.get(5, 0))
+    def read_tags(self, keys, values):
+        strings = self.strings
+        return self.tag_sets.share(dict([(strings[k], strings[v]) for k, v in zip(keys, values)]))
+    def add(self, item):
+        if self.keep(item):
+            if isinstance(item, Node):
+                self.osm.add_node(item)
+            elif isinstance(item, Way):
+                self.osm.add_way(item)
+            else:
+                self.osm.add_relation(item)
+    def read_node(self, data):
+        attrs = {}
+        keys = values = ()
+        for number, value in pbf_iter_fields(data):
+            if number == 1:
+                attrs["id"] = pbf_unzigzag(value)
+            elif number == 2:
+                keys = pbf_packed(value)
+            elif number == 3:
+                values = pbf_packed(value)
+            elif number == 4:
+                attrs.update(self.read_info(value))
+            elif number == 8:
+                attrs["lat"] = self.coordinate(self.lat_offset, pbf_unzigzag(value))
+            elif number == 9:
+                attrs["lon"] = self.coordinate(self.lon_offset, pbf_unzigzag(value))
+        self.add(Node(attrs, self.read_tags(keys, values)))
+    def read_dense_nodes(self, data):
+        ids = lats = lons = keys_vals = ()
+        dense_info = {}
+        for number, value in pbf_iter_fields(data):
+            if number == 1:
+                ids = pbf_delta(pbf_packed(value))
+            elif number == 5:
+                for info_number, info_value in pbf_iter_fields(value):
+                    if info_number == 1:
+                        dense_info[1] = [pbf_int64(v) for v in pbf_packed(info_value)]
+                    elif info_number in (2, 3, 4, 5):
+                        dense_info[info_number] = pbf_delta(pbf_packed(info_value))
+            elif number == 8:
+                lats = pbf_delta(pbf_packed(value))
+            elif number == 9:
+                lons = pbf_delta(pbf_packed(value))
+            elif number == 10:
+                keys_vals = pbf_packed(value)
+        strings = self.strings
+        kv_pos = 0
+        for i, id in enumerate(ids):
+            tags = {}
+            while kv_pos < len(keys_vals) and keys_vals[kv_pos] != 0:
+                tags[strings[keys_vals[kv_pos]]] = strings[keys_vals[kv_pos + 1]]
+                kv_pos += 2
+            kv_pos += 1
+            tags = self.tag_sets.share(tags)
+            if dense_info:
+                attrs = self.info_attrs(*[
+                    dense_info[n][i] if n in dense_info else 0 for n in (1, 2, 3, 4, 5)])
+            else:
+                attrs = {}
+            attrs["id"] = id
+            attrs["lat"] = self.coordinate(self.lat_offset, lats[i])
+            attrs["lon"] = self.coordinate(self.lon_offset, lons[i])
+            self.add(Node(attrs, tags))
+    def read_way(self, data):
+        attrs = {}
+        keys = values = refs = ()
+        for number, value in pbf_iter_fields(data):
+            if number == 1:
+                attrs["id"] = pbf_int64(value)
+            elif number == 2:
+                keys = pbf_packed(value)
+            elif number == 3:
+                values = pbf_packed(value)
+            elif number == 4:
+                attrs.update(self.read_info(value))
+            elif number == 8:
+                refs = pbf_delta(pbf_packed(value))
+        way = Way(attrs, self.read_tags(keys, values))
+        way.nodes.extend(refs)
+        self.add(way)
+    def read_relation(self, data):
+        attrs = {}
+        keys = values = roles = memids = types = ()
+        for number, value in pbf_iter_fields(data):
+            if number == 1:
+                attrs["id"] = pbf_int64(value)
+            elif number == 2:
+                keys = pbf_packed(value)
+            elif number == 3:
+                values = pbf_packed(value)
+            elif number == 4:
+                attrs.update(self.read_info(value))
+            elif number == 8:
+                roles = pbf_packed(value)
+            elif number == 9:
+                memids = pbf_delta(pbf_packed(value))
+            elif number == 10:
+                types = pbf_packed(value)
+        relation = Relation(attrs, self.read_tags(keys, values))
+        for role, memid, mtype in zip(roles, memids, types):
+            relation.add_member_type_ref_role(MEMBER_TYPES[mtype], memid, self.strings[role])
+        self.add(relation)
+
+
+class PbfWriter(object):
+    """Write an Osm object to a .osm.pbf file, with zlib compressed blocks
+       of dense nodes, ways and relations.
+       Only id, version, timestamp, changeset, uid and user attributes can
+       be stored: the action attribute of modified items is lost.
+    """
+    def __init__(self, osm):
+        self.osm = osm
+    def write_to_file(self, filename):
+        with open(filename, "wb") as output:
+            self.write_to_stream(output)
+    def write_to_stream(self, stream):
+        self.output = stream
+        self.write()
+    def write(self):
+        osm = self.osm
+        header = b""
+        bbox = osm.bbox() if osm.bounds else None
+        if bbox:
+            minlon, minlat, maxlon, maxlat = bbox
+            header += pbf_field_bytes(1,
+                pbf_field_varint(1, pbf_zigzag(int(round(minlon * 1e9))))
+                + pbf_field_varint(2, pbf_zigzag(int(round(maxlon * 1e9))))
+                + pbf_field_varint(3, pbf_zigzag(int(round(maxlat * 1e9))))
+                + pbf_field_varint(4, pbf_zigzag(int(round(minlat * 1e9)))))
+        header += pbf_field_bytes(4, b"OsmSchema-V0.6")
+        header += pbf_field_bytes(4, b"DenseNodes")
+        header += pbf_field_bytes(16, osm.attrs.get("generator", "osm.py").encode("utf-8"))
+        self.write_blob("OSMHeader", header)
+        for items, write_group in (
+                (list(itervalues(osm.nodes)), self.dense_nodes_group),
+                (list(itervalues(osm.ways)), self.ways_group),
+                (list(itervalues(osm.relations)), self.relations_group)):
+            for start in range(0, len(items), PBF_MAX_BLOCK_ITEMS):
+                self.strings = {"": 0}
+                group = write_group(items[start:start + PBF_MAX_BLOCK_ITEMS])
+                strings = sorted(self.strings, key=self.strings.get)
+                string_table = b"".join([pbf_field_bytes(1, s.encode("utf-8")) for s in strings])
+                self.write_blob("OSMData",
+                    pbf_field_bytes(1, string_table)
+                    + pbf_field_bytes(2, group)
+                    + pbf_field_varint(17, PBF_GRANULARITY))
+    def write_blob(self, blob_type, data):
+        blob = pbf_field_varint(2, len(data)) + pbf_field_bytes(3, zlib.compress(data))
+        blob_header = pbf_field_bytes(1, blob_type.encode("utf-8")) + pbf_field_varint(3, len(blob))
+        self.output.write(struct.pack("!I", len(blob_header)))
+        self.output.write(blob_header)
+        self.output.write(blob)
+    def string_id(self, string):
+        string_id = self.strings.get(string)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.strings[string] = string_id
+        return string_id
+    def info(self, item):
+        attrs = item.attrs
+        version = item.version()
+        timestamp = attrs.get("timestamp")
+        return (
+            version if version is not None else 0,
+            pbf_parse_timestamp(timestamp) if timestamp else 0,
+            int(attrs.get("changeset", 0)),
+            int(attrs.get("uid", 0)),
+            self.string_id(attrs["user"]) if "user" in attrs else 0)
+    def info_field(self, item):
+        version, timestamp, changeset, uid, user_sid = self.info(item)
+        return pbf_field_bytes(4,
+            pbf_field_varint(1, version)
+            + pbf_field_varint(2, timestamp)
+            + pbf_field_varint(3, changeset)
+            + pbf_field_varint(4, uid)
+            + pbf_field_varint(5, user_sid))
+    def tags_fields(self, item):
+        keys = []
+        values = []
+        for key, value in iteritems(item.tags):
+            keys.append(self.string_id(key))
+            values.append(self.string_id(value))
+        return pbf_field_packed(2, keys) + pbf_field_packed(3, values)
+    def dense_nodes_group(self, nodes):
+        ids = [node.id() for node in nodes]
+        lats = [int(round(node.lat() * 1e9 / PBF_GRANULARITY)) for node in nodes]
+        lons = [int(round(node.lon() * 1e9 / PBF_GRANULARITY)) for node in nodes]
+        infos = [self.info(node) for node in nodes]
+        keys_vals = []
+        for node in nodes:
+            for key, value in iteritems(node.tags):
+                keys_vals.append(self.string_id(key))
+                keys_vals.append(self.string_id(value))
+            keys_vals.append(0)
+        dense = pbf_field_packed(1, pbf_deltas(ids))
+        dense += pbf_field_bytes(5,
+            pbf_field_packed(1, [pbf_varint_int32(info[0]) for info in infos])
+            + pbf_field_packed(2, pbf_deltas([info[1] for info in infos]))
+            + pbf_field_packed(3, pbf_deltas([info[2] for info in infos]))
+            + pbf_field_packed(4, pbf_deltas([info[3] for info in infos]))
+            + pbf_field_packed(5, pbf_deltas([info[4] for info in infos])))
+        dense += pbf_field_packed(8, pbf_deltas(lats))
+        dense += pbf_field_packed(9, pbf_deltas(lons))
+        if any(keys_vals):
+            dense += pbf_field_packed(10, keys_vals)
+        return pbf_field_bytes(2, dense)
+    def ways_group(self, ways):
+        group = b""
+        for way in ways:
+            group += pbf_field_bytes(3,
+                pbf_field_varint(1, way.id())
+                + self.tags_fields(way)
+                + self.info_field(way)
+                + pbf_field_packed(8, pbf_deltas(list(way.nodes))))
+        return group
+    def relations_group(self, relations):
+        group = b""
+        for relation in relations:
+            members = list(relation.itermembers())
+            group += pbf_field_bytes(4,
+                pbf_field_varint(1, relation.id())
+                + self.tags_fields(relation)
+                + self.info_field(relation)
+                + pbf_field_packed(8, [self.string_id(role) for mtype, ref, role in members])
+                + pbf_field_packed(9, pbf_deltas([ref for mtype, ref, role in members]))
+                + pbf_field_packed(10, [MEMBER_TYPE_CODE[mtype] for mtype, ref, role in members]))
+        return group
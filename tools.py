@@ -23,6 +23,7 @@ import itertools
 import subprocess
 import unicodedata
 import timeit
+import pickle
 from functools import reduce
 
 def write_string_to_file(string, filename):
@@ -79,6 +80,34 @@ class open_cached:
             os.unlink(self.check_filename)
             return False
 
+def load_cached(load_function, cache_filename, key):
+    """Return load_function() result, cached with pickle in cache_filename.
+       As for open_cached, a .ok file tells that the cache was completely
+       written; it also contains the key, and the cache is only reused when
+       the key is the same (for instance a size and mtime of the source).
+    """
+    check_filename = cache_filename + ".ok"
+    if os.path.exists(cache_filename) and os.path.exists(check_filename):
+        with open(check_filename) as f:
+            cached_key = f.read()
+        if cached_key == key:
+            try:
+                with open(cache_filename, "rb") as f:
+                    return pickle.load(f)
+            except Exception as e:
+                print("WARNING: ignore invalid cache " + cache_filename + ": " + str(e))
+    result = load_function()
+    try:
+        if os.path.exists(check_filename):
+            os.unlink(check_filename)
+        with open(cache_filename, "wb") as f:
+            pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+        with open(check_filename, "w") as f:
+            f.write(key)
+    except (OSError, pickle.PicklingError) as e:
+        print("WARNING: cannot write cache " + cache_filename + ": " + str(e))
+    return result
+
 def print_flush(text):
     sys.stdout.write((text + "\n").encode("utf-8"))
     sys.stdout.flush()
@@ -234,6 +263,13 @@ def test(argv):
         pass
     assert(not os.path.exists("/tmp/test_cache.ok"))
 
+    #load_cached
+    for f in ("/tmp/test_load_cache", "/tmp/test_load_cache.ok"):
+        if os.path.exists(f): os.unlink(f)
+    assert(load_cached(lambda : [1, 2], "/tmp/test_load_cache", "a") == [1, 2])
+    assert(load_cached(lambda : [3], "/tmp/test_load_cache", "a") == [1, 2])
+    assert(load_cached(lambda : [3], "/tmp/test_load_cache", "b") == [3])
+
 
 if __name__ == '__main__':
     test(sys.argv)